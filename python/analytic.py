@@ -0,0 +1,155 @@
+import math
+
+import quartermaster as qm
+
+# Closed-form estimates of a simulation's stats(), in a fraction of a millisecond rather than the seconds a
+# run takes, for screening configurations before simulating the ones that matter (see sweep(hybrid=True)).
+#
+# Only requests that miss the cache call the dependency, and p1 holds each request until it is responded
+# to, so the server behaves like a queue with p2_max servers and room for p1_max + q1_max requests in all.
+# Requests beyond that room are rejected, or, when q2 would overflow first, get a fallback. A call takes
+# the dependency's normal distribution of latency, cut off at its timeout, plus half a tick on average for
+# completions being seen on the next whole tick. A request makes up to Server.tries calls, stopping at the
+# first success.
+#
+# The queue is solved as M/M/c/K with the decay of its queue-length distribution adjusted for how variable
+# arrivals and service are (a diffusion approximation), which is reasonable away from saturation but not
+# close to it. Other settings the model does not cover make the estimate unreliable; see applies().
+
+_arrival_variability = {'periodic': 0.0, 'poisson': 1.0}  # squared coefficient of variation of intervals
+
+
+def _pdf(z):
+    return math.exp(-z*z/2) / math.sqrt(2*math.pi)
+
+
+def _cdf(z):
+    return 0.5 * (1 + math.erf(z / math.sqrt(2)))
+
+
+def call_model(Dependency):
+    # (mean, variance, P(success)) of a call's time, cut off at the timeout
+    mu, sd, c = Dependency.mean, Dependency.std, Dependency.timeout
+    z = (c - mu) / sd
+    within = _cdf(z)
+    mean = mu * within - sd * _pdf(z) + c * (1 - within)
+    second = (mu*mu + sd*sd) * within - sd * (mu + c) * _pdf(z) + c*c * (1 - within)
+    return mean, max(0, second - mean*mean), within * Dependency.availability
+
+
+def hit_rate(Client, Server, success, points=200):
+    # A key's entry is written when a call for it succeeds and is read until it expires, so each cycle is
+    # 1/success misses (on average) followed by the requests in the next ttl ticks, all hits. Keys are drawn
+    # as in Simulation.sample(), whose density rises steeply towards key_space; this sums the hit rate over
+    # them by the midpoint rule.
+    if Server.ttl <= 0 or success <= 0:
+        return 0.0
+
+    slope = 25  # exponential()'s default
+    h = 0
+    for i in range(points):
+        y = (i + 0.5) / points
+        density = slope * math.exp(slope * (y - 1)) / (1 - math.exp(-slope))
+        hits = density / Client.key_space / Client.rate * Server.ttl  # per cycle
+        h += density / points * hits / (1/success + hits)
+    return h
+
+
+def _cached_value(Client, Server, points=16):
+    # Mean value of a cached response, taking the age of entries when read as uniform over the ttl
+    ages = ((i + 0.5) / points * Server.ttl for i in range(points))
+    return sum(qm.sigmoid(age, Client.cache_age_max, Client.cache_age_k) for age in ages) / points
+
+
+def occupancy(arrival_rate, service, servers, room, variability):
+    # Distribution of the number of requests in a queue with the given number of servers and room for, in
+    # all, served and waiting: M/M/c/K, with the ratio between successive queue lengths raised to the power
+    # 1/variability so that queues build up less when arrivals and service are regular
+    offered = arrival_rate * service
+    log_p = [0.0]
+    for n in range(1, min(servers, room) + 1):
+        log_p.append(log_p[-1] + math.log(offered / n) if offered else -math.inf)
+
+    if room > servers and offered:
+        log_ratio = math.log(offered / servers) / max(variability, 1e-6)
+        for n in range(servers + 1, room + 1):
+            log_p.append(log_p[-1] + log_ratio)
+
+    top = max(log_p)
+    p = [math.exp(lp - top) for lp in log_p]
+    total = sum(p)
+    return [x / total for x in p]
+
+
+def applies(Client, Server, Dependency):
+    # Whether the settings are ones the model covers (it knows nothing of replaced strategies either)
+    return (Client.arrivals in _arrival_variability and Server.admission == 'none' and
+            Server.cache_policy in ('unbounded', 'ttl'))
+
+
+def estimate(Client=None, Server=None, Dependency=None, ticks=200000):
+    # stats()-shaped estimates of a run of the given ticks, plus 'utilization': the load on p2 as a
+    # fraction of what it can take
+    Client = Client or qm.Client
+    Server = Server or qm.Server
+    Dependency = Dependency or qm.Dependency
+
+    call_t, call_var, success = call_model(Dependency)
+    service_call = call_t + 0.5
+    fail = 1 - success
+    calls = sum(fail ** i for i in range(max(Server.tries, 1)))
+    served_live = 1 - fail ** max(Server.tries, 1)
+    service = calls * service_call
+    calls_var = sum((2*i + 1) * fail ** i for i in range(max(Server.tries, 1))) - calls * calls
+    service_var = calls * call_var + calls_var * service_call ** 2
+
+    arrival_rate = 1 / Client.rate
+    h = hit_rate(Client, Server, success)
+    miss_rate = arrival_rate * (1 - h)
+
+    servers = min(Server.p2_max, Server.p1_max)
+    evicting = Server.p1_max > servers + Server.q2_max
+    in_server = servers + Server.q2_max if evicting else Server.p1_max
+    room = in_server if evicting else in_server + Server.q1_max
+    # Poisson arrivals keep M/M/c/K's decay: halving it, as for M/D/c, made waits well short of simulated ones
+    arrivals = _arrival_variability.get(Client.arrivals, 1.0)
+    variability = max(arrivals, (arrivals + service_var / service**2) / 2)
+
+    # The servers are busy for service ticks per admitted request, which bounds blocking too. The two agree
+    # for M/M/c/K; the bound is what keeps regular arrivals that overload the server, all piled up at the
+    # limit (p[room] close to 1), at the rate the servers can take.
+    p = occupancy(miss_rate, service, servers, room, variability)
+    busy = sum(pn * min(n, servers) for n, pn in enumerate(p))
+    blocked = min(p[room], max(0, 1 - busy / service / miss_rate)) if miss_rate else 0
+    admitted_misses = miss_rate * (1 - blocked) or 1e-12
+    q1 = sum(pn * max(0, n - in_server) for n, pn in enumerate(p)) / admitted_misses
+    q2 = sum(pn * max(0, min(n, in_server) - servers) for n, pn in enumerate(p)) / admitted_misses
+    q1 += 1  # p1 picks up arrivals on the following tick
+
+    # Response types, as fractions of arrivals, with their latency and value
+    rejected = 0 if evicting else blocked
+    misses = (1 - rejected) * (1 - h) * (1 - (blocked if evicting else 0))
+    types = {
+        'rejected': (rejected, 0, 0, Client.rejected, 0),
+        'cached': ((1 - rejected) * h, q1, 0, _cached_value(Client, Server), 0),
+        'live': (misses * served_live, q1 + q2 + service, calls, Client.live, calls * call_t),
+        'fallback': ((1 - rejected) * (1 - h) - misses * served_live, q1 + q2 + service, calls,
+                     Client.fallback, calls * call_t)}
+    if evicting:
+        # Evicted on the way into q2: a fallback straight away, with no call made
+        evicted = (1 - h) * blocked
+        live_share = types['fallback'][0] - evicted
+        types['fallback'] = (types['fallback'][0], (evicted * q1 + live_share * (q1 + service)) /
+                             (types['fallback'][0] or 1), calls, Client.fallback, calls * call_t)
+
+    s = {'count': round(arrival_rate * ticks)}
+    for metric, index in (('latency', 1), ('tries', 2), ('dependency', 4)):
+        s[metric] = sum(t[0] * t[index] for t in types.values())
+    s['qos'] = sum(share * value * qm.sigmoid(latency, Client.decay_max, Client.decay_k)
+                   for share, latency, tries, value, dep in types.values())
+    s['q1'] = (1 - rejected) * q1
+    s['q2'] = misses * q2
+    s['throughput'] = 1000 * arrival_rate * types['live'][0]
+    s['hit_rate'] = h
+    s['utilization'] = miss_rate * service / servers
+    return s
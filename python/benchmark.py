@@ -0,0 +1,190 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+import quartermaster as qm
+import sweep
+
+# Benchmarks of the simulator itself: how many ticks and requests it gets through per second, how that scales
+# with queue sizes, pool sizes and key space, how much memory a run of a million requests or so takes, and
+# what stats() and report() cost. Each benchmark runs in a fresh process, so that its peak memory is its own,
+# and its timings are the best of a few repeats, the usual way of taking out noise from the rest of the
+# machine. Results are saved as JSON, and a saved run can be compared against another to catch regressions
+# between revisions:
+#
+#   python benchmark.py --output before.json
+#   (change things)
+#   python benchmark.py --output after.json --compare before.json
+#
+# --scale shortens (or lengthens) every run, e.g. --scale 0.1 for a quick check; only runs at the same scale
+# are worth comparing.
+
+# name -> (settings, as for a sweep point; ticks at scale 1; whether to time stats() and report() as well)
+benchmarks = {
+    'default': ({}, 1000000, True),
+    'default_tick': ({'Engine.mode': 'tick'}, 200000, False),
+}
+
+
+def abandon_scan(r):
+    # The default rule, replaced without a revisit(), so that abandon() is asked about all of q2 every step
+    return qm.Simulation.abandon(qm._sim, r)
+
+
+# Overloaded (no cache), so that the queues are full: abandon() is asked about requests as they become due
+# (see Simulation.revisit), and with abandon_scan about all of q2 every step. p1 holds each request until it
+# is responded to, so p1_max has to leave room for q2 as well as p2.
+for n in (10, 100, 1000):
+    overloaded = {'Server.ttl': 0, 'Server.q1_max': n, 'Server.q2_max': n,
+                  'Server.p1_max': n + qm.Server.p2_max}
+    benchmarks['queues_%d' % n] = (overloaded, 200000, False)
+    benchmarks['queues_scan_%d' % n] = (dict(overloaded, **{'Simulation.abandon': abandon_scan}), 200000, False)
+
+# Load kept in proportion to p2_max, so that the pools are about as busy as by default
+for n in (5, 50, 500):
+    benchmarks['pools_%d' % n] = ({'Server.p2_max': n, 'Server.p1_max': 2 * n, 'Client.arrivals': 'poisson',
+                                   'Client.rate': 25 * 5 / n}, 200000, False)
+
+for n in (50000, 500000, 5000000):
+    benchmarks['keys_%d' % n] = ({'Client.key_space': n}, 1000000, False)
+
+# A million requests or so, with the requests kept (and stats() over them timed) and without
+busy = {'Client.rate': 5, 'Server.p2_max': 30, 'Server.p1_max': 60, 'Server.q1_max': 60, 'Server.q2_max': 60}
+benchmarks['million_kept'] = (dict(busy, **{'Engine.keep_requests': True}), 5000000, True)
+benchmarks['million'] = (busy, 5000000, False)
+
+# Whether more is better, per metric; the rest are informational
+higher_is_better = {'ticks_per_second': True, 'requests_per_second': True, 'memory_mb': False,
+                    'peak_mb': False, 'stats_ms': False, 'report_ms': False, 'stats_requests_ms': False}
+
+
+def _peak_mb():
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _best_ms(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return 1000 * best
+
+
+def run_benchmark(settings, ticks, report, repeat, seed):
+    before = _peak_mb()
+    best = None
+    for _ in range(repeat):
+        sim = qm._sim = qm.Simulation(seed=seed, **sweep.simulation_args(settings))  # for abandon_scan
+        start = time.perf_counter()
+        sim.main(ticks)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    requests = sim.totals.stats()['count']
+    result = {
+        'ticks': ticks,
+        'requests': requests,
+        'seconds': best,
+        'ticks_per_second': ticks / best,
+        'requests_per_second': requests / best,
+        'memory_mb': _peak_mb() - before,  # over what the process took before the runs
+        'peak_mb': _peak_mb()}
+
+    if report:
+        result['stats_ms'] = _best_ms(sim.stats)
+        result['report_ms'] = _best_ms(sim.report)
+        if sim.completed:
+            result['stats_requests_ms'] = _best_ms(lambda: sim.stats(sim.completed), repeat=1)
+
+    return result
+
+
+def run(names=None, scale=1.0, repeat=3, seed=0):
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name in names or benchmarks:
+        settings, ticks, report = benchmarks[name]
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            ticks = max(1, int(ticks * scale))
+            result = pool.submit(run_benchmark, settings, ticks, report, repeat, seed).result()
+        results[name] = result
+        print("%-16s %10.0f ticks/s %10.0f requests/s %8.1f MB" %
+              (name, result['ticks_per_second'], result['requests_per_second'], result['memory_mb']))
+        sys.stdout.flush()
+
+    return {'revision': _revision(), 'python': platform.python_version(), 'machine': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scale': scale, 'repeat': repeat,
+            'results': results}
+
+
+def _revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, tolerance=0.1):
+    # Prints the change in each metric between two runs and returns the regressions: (benchmark, metric,
+    # relative change) for each metric that got worse by more than tolerance
+    if old.get('scale') != new.get('scale'):
+        print("warning: comparing runs at scale %s and %s" % (old.get('scale'), new.get('scale')))
+
+    regressions = []
+    print("%-16s %-20s %12s %12s %8s" %
+          ('benchmark', 'metric', old.get('revision'), new.get('revision'), 'change'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        for metric, higher in higher_is_better.items():
+            a, b = old['results'][name].get(metric), result.get(metric)
+            if a is None or b is None:
+                continue
+
+            change = (b - a) / a if a else 0
+            worse = -change if higher else change
+            flag = 'REGRESSION' if worse > tolerance else ''
+            if flag:
+                regressions.append((name, metric, change))
+            print("%-16s %-20s %12.1f %12.1f %+7.1f%% %s" % (name, metric, a, b, 100 * change, flag))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the simulator')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run (default: all of %s)' % ', '.join(benchmarks))
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the ticks of every run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark; the fastest counts')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change beyond which a metric counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args.names, args.scale, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import time
+
+import quartermaster as qm
+import sweep
+
+# Runs the server for real: q1/p1 -> q2/p2 as asyncio tasks on the wall clock, in front of a stub dependency
+# whose latency and failures follow the Dependency model, with load driven at Client.rate. Everything but
+# the engine is quartermaster's own (strategies, queues, cache, admission and stats()), so what a strategy
+# does here can be checked against what the simulation predicts for it, under real concurrency and with
+# the event loop's own overheads.
+#
+# A tick is `tick` seconds of wall-clock time (a millisecond by default), and the clock reads in whole ticks
+# like the simulation's. The stub either runs in-process or listens on localhost, where each p2 worker keeps
+# a connection of its own; it can also be run on its own (--serve) for another process to call (--stub).
+#
+#   python live.py --seconds 20            # simulated against live, default configuration
+#   python live.py --seconds 20 --remote   # the same through a localhost stub
+
+
+class WallClock:
+    # Whole ticks since start(); now() has the fraction too
+    def __init__(self, tick):
+        self.tick = tick
+        self.origin = None
+
+    def start(self):
+        self.origin = time.perf_counter()
+
+    def now(self):
+        return (time.perf_counter() - self.origin) / self.tick if self.origin is not None else 0
+
+    @property
+    def ts(self):
+        return int(self.now())
+
+    def delay(self, ts):
+        # Seconds until tick ts, if it is still to come
+        return max(0, ts * self.tick - (time.perf_counter() - self.origin))
+
+
+class StubDependency:
+    # In-process: each call takes the latency drawn from model's dependency() and ends as it says
+    def __init__(self, model, tick):
+        self.model = model
+        self.tick = tick
+
+    async def connect(self):
+        return self
+
+    async def call(self):
+        t, result = self.model.dependency()
+        await asyncio.sleep(t * self.tick)
+        return result
+
+    async def close(self):
+        pass
+
+
+class StubServer(StubDependency):
+    # The same on localhost: a call is a line sent ("call"), answered with the result after the latency
+    def __init__(self, model, tick, host='127.0.0.1', port=0):
+        super().__init__(model, tick)
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            while await reader.readline():
+                writer.write((await self.call()).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass  # the caller went away, or the stub is shutting down with calls in progress
+        finally:
+            writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class RemoteDependency:
+    # Calls a StubServer, over one connection per p2 worker
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    async def connect(self):
+        connection = RemoteDependency(self.host, self.port)
+        connection.reader, connection.writer = await asyncio.open_connection(self.host, self.port)
+        return connection
+
+    async def call(self):
+        self.writer.write(b'call\n')
+        await self.writer.drain()
+        return (await self.reader.readline()).decode().strip()
+
+    async def close(self):
+        self.writer.close()
+
+
+class LiveSimulation(qm.Simulation):
+    # A Simulation run by asyncio tasks on a WallClock instead of by main(). Arrivals come from the usual
+    # arrival process, each on its tick; p1_max workers each take a request from q1 and hold it until it is
+    # responded to, as P1Worker does; p2_max workers each take requests from q2 and call the dependency.
+    # abandon() is asked about requests as they enter q2, before a p2 worker can take them, and then as
+    # revisit() says or, failing that, every tick. Given remote, an (host, port) of a StubServer, the
+    # dependency is called there; otherwise in-process.
+
+    def __init__(self, Client=None, Server=None, Dependency=None, Engine=None, seed=None, tick=0.001,
+                 remote=None, **strategies):
+        self.tick = tick
+        self.remote = remote
+        super().__init__(Client, Server, Dependency, Engine, seed, **strategies)
+
+    def setup(self):
+        super().setup()
+        self.clock = WallClock(self.tick)
+        self.cache.clock = self.clock
+        self.waiting = {}  # request -> future its p1 worker waits on
+        self.lag = qm.Tally()  # ticks by which arrivals ran behind schedule
+
+    def schedule(self, ts, kind):
+        pass  # the tasks keep their own time
+
+    def respond(self, r, response_type=None):
+        super().respond(r, response_type)
+        future = self.waiting.pop(r, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def enqueue_or_respond(self, q2, r):
+        super().enqueue_or_respond(q2, r)
+        if r.queue is q2:
+            self.abandon_q2()
+            if not q2.empty():
+                self.q2_ready.set()
+
+    #
+    # Tasks
+    #
+
+    async def arrive_task(self):
+        clock, q1 = self.clock, self.q1
+        ts = clock.ts
+        while True:
+            ts = self.arrivals.next_ts(ts)
+            if ts is None:
+                return
+            await asyncio.sleep(clock.delay(ts))
+
+            self.lag.add(clock.now() - ts)
+            for r in self.arrivals.arrivals(ts):
+                if self.Engine.keep_requests:
+                    self.created.append(r)
+                if q1.full(self.Server.q1_max) or not self.admission.admit(r):
+                    self.respond(r, 'rejected')
+
+                else:
+                    q1.enqueue(r)
+                    self.q1_ready.set()
+
+    async def p1_task(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while self.q1.empty():
+                self.q1_ready.clear()
+                await self.q1_ready.wait()
+
+            r = self.q1.dequeue()
+            future = self.waiting[r] = loop.create_future()
+            qm.P1Worker(self, r)
+            await future
+
+    async def p2_task(self, dependency):
+        clock = self.clock
+        connection = await dependency.connect()
+        try:
+            while True:
+                while self.q2.empty():
+                    self.q2_ready.clear()
+                    await self.q2_ready.wait()
+
+                r = self.q2.dequeue()
+                start = clock.now()
+                if r.recorded:
+                    t, result = self.replay(r)
+                    await asyncio.sleep(t * self.tick)
+                else:
+                    result = await connection.call()
+
+                t = clock.now() - start
+                r.dependency_t += t
+                r.tries += 1
+                self.health.record(clock.ts, t, result)
+                if result == 'success':
+                    self.cache.write(r.key)
+                    self.respond(r, 'live')
+
+                else:  # for possible retry
+                    self.enqueue_or_respond(self.q2, r)
+        finally:
+            await connection.close()
+
+    async def abandon_task(self):
+        # Due requests on their tick; all of q2 every tick when abandon() has no revisit()
+        while True:
+            self.abandon_q2()
+            if self.scan_abandon or not self.abandon_due:
+                await asyncio.sleep(self.tick)
+            else:
+                await asyncio.sleep(self.clock.delay(self.abandon_due[0][0]))
+
+    #
+    # Running
+    #
+
+    async def run_async(self, seconds, warmup=0):
+        self.q1_ready = asyncio.Event()
+        self.q2_ready = asyncio.Event()
+        dependency = StubDependency(self, self.tick) if self.remote is None else RemoteDependency(*self.remote)
+
+        self.clock.start()
+        tasks = [asyncio.create_task(self.arrive_task()), asyncio.create_task(self.abandon_task())]
+        tasks += [asyncio.create_task(self.p1_task()) for _ in range(self.Server.p1_max)]
+        tasks += [asyncio.create_task(self.p2_task(dependency)) for _ in range(self.Server.p2_max)]
+
+        await asyncio.sleep(warmup)
+        self.clear()
+        self.lag = qm.Tally()
+        start = time.perf_counter()
+        await asyncio.sleep(seconds)
+        elapsed = time.perf_counter() - start
+
+        s = self.stats()
+        if self.export:
+            self.export.flush()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        s['requests_per_second'] = s['count'] / elapsed
+        s['target_per_second'] = 1 / (self.Client.rate * self.tick)
+        s['arrival_lag'] = self.lag.mean()
+        return s
+
+    def run(self, seconds, warmup=0):
+        # stats() of the requests responded to over seconds of wall-clock time after warmup seconds, with the
+        # responses per second achieved, the rate aimed at, and how far behind schedule (in ticks) arrivals
+        # were on average, which is the event loop failing to keep up
+        return asyncio.run(self.run_async(seconds, warmup))
+
+
+def _run_remote(sim, seconds, warmup):
+    # The stub on localhost, served from the same event loop
+    async def run():
+        server = StubServer(sim, sim.tick)
+        await server.start()
+        sim.remote = (server.host, server.port)
+        try:
+            return await sim.run_async(seconds, warmup)
+        finally:
+            await server.stop()
+
+    return asyncio.run(run())
+
+
+async def _serve(port, tick):
+    server = StubServer(qm.Simulation(), tick, port=port)
+    await server.start()
+    print("stub dependency on %s:%d" % (server.host, server.port))
+    await server.server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the server live against a stub dependency')
+    parser.add_argument('--seconds', type=float, default=20, help='of measurement, after warmup')
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--tick', type=float, default=0.001, help='seconds per tick')
+    parser.add_argument('--remote', action='store_true', help='call a stub on localhost')
+    parser.add_argument('--stub', help='HOST:PORT of a stub started with --serve')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='only serve a stub dependency')
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        asyncio.run(_serve(args.serve, args.tick))
+
+    else:
+        ticks = round(args.seconds / args.tick)
+        simulated = qm.Simulation(seed=0)
+        simulated.warmup(round(args.warmup / args.tick))
+        simulated.main(simulated.clock.ts + ticks)
+
+        if args.stub:
+            host, _, port = args.stub.rpartition(':')
+            live = LiveSimulation(seed=0, tick=args.tick, remote=(host, int(port)))
+            live_stats = live.run(args.seconds, args.warmup)
+        else:
+            live = LiveSimulation(seed=0, tick=args.tick)
+            if args.remote:
+                live_stats = _run_remote(live, args.seconds, args.warmup)
+            else:
+                live_stats = live.run(args.seconds, args.warmup)
+
+        rows = [dict(engine='simulated', **simulated.stats()), dict(engine='live', **live_stats)]
+        sweep.print_table(rows)
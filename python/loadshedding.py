@@ -31,3 +31,34 @@ for c_1 in [4, 3, 2, 1, 0]:
         print("\n\t(rejected?) RATE=", qm.Client.rate)
         qm.warmup()
         qm.run_experiment(200000)
+
+# ADMISSION CONTROL
+
+# The runs above approximate C1 and C2 with pool sizes, so nothing is admitted or rejected on the basis of how many requests are actually in flight, and each load level needs its own hand-picked sizes. The server's admission control (Server.admission) does this directly at the point where arrivals are rejected. Here the dependency can take c_max calls at once, the pools and queues are large enough not to matter, and each policy is run at the same rising arrival rates: no limit, a static Cmax, the C1/C2 split (C1 = 3 and so C2 = 4 at a quarter of the cost), and the adaptive AIMD and gradient limits, which start at Cmax and find their own level.
+
+import sweep
+
+qm.Server.p1_max = qm.Server.q1_max = qm.Server.q2_max = 50
+qm.Server.p2_max = c_max
+qm.Server.admission_limit = c_max
+
+policies = [{'Server.admission': 'none'},
+            {'Server.admission': 'static'},
+            {'Server.admission': 'two-threshold', 'Server.admission_normal': 3},
+            {'Server.admission': 'aimd'},
+            {'Server.admission': 'gradient'}]
+
+points = []
+for policy in policies:
+    for rate in [50, 40, 30, 20, 10]:
+        points.append(dict(policy, **{'Client.rate': rate}))
+
+# The points run one after another (processes=1): this script has no __main__ guard, so worker processes
+# started by spawn or forkserver would run all of it again.
+
+print("\nadmission, rate, qos, latency, throughput, limit")
+for row in sweep.sweep(points, processes=1):
+    print("%s,%d,%.2f,%.1f,%.2f,%.1f" %
+          (row['Server.admission'], row['Client.rate'], row['qos'], row['latency'], row['throughput'], row['limit']))
+
+# Without a limit the server collapses once arrivals outpace the dependency (from a rate of 30 here). A static Cmax avoids that, but sheds load it could have handled (at a rate of 40). The adaptive limits match the unlimited server while it copes and, under overload, AIMD stays close to the static Cmax. The gradient limit lets latency rise further before it backs off, which keeps throughput up at the expense of QoS; GradientAdmission.tolerance sets that trade-off.
@@ -1,15 +1,166 @@
 #
 # Stats utilities
 #
+import bisect
+import csv
+import heapq
+import json
 import math
-from random import random
+import mmap
+import operator
+import os
+import pickle
+import struct
+import sys
+from array import array
+from collections import OrderedDict, deque
+from functools import partial
+from itertools import chain
+from random import Random, getrandbits, getstate, random, setstate
+from time import perf_counter
+
+
+# Each utility draws from the module's random() unless given another source of uniform [0, 1) values,
+# which may be a Variates. Simulations instead draw through a Variates, or Draws around a plain source,
+# whose methods need no check of what kind of source they are given.
+
+
+class Draws:
+    # The draws a Variates hands out, for a plain source of uniforms such as random() or a Random's random(),
+    # computed one at a time as the utilities compute them
+
+    def __init__(self, random):
+        self.uniform = random
+
+    def std_normal(self):
+        random = self.uniform
+        u = v = 0
+        while u == 0:
+            u = random()
+        while v == 0:
+            v = random()
+
+        return math.sqrt(-2.0 * math.log(u)) * math.cos(2.0 * math.pi * v)
+
+    def std_exponential(self):
+        return -math.log(1.0 - self.uniform())
+
+    def exponential(self, max=1, slope=25):
+        return max * math.log(1-(1-math.e**slope)*self.uniform())/slope
+
+
+class Variates:
+    # A seedable source of variates that draws them from NumPy in batches of size and hands them out one
+    # at a time, which costs a fraction of generating each in Python. Calling it gives a uniform [0, 1)
+    # value, so it can stand in for random(). NumPy is only needed once one is created.
+    #
+    # uniform(), std_normal() and std_exponential() are each the __next__ of an itertools.chain over their
+    # batches, bound to the instance, so that only the call for a new batch runs any Python. The chains
+    # cannot be pickled, so what is left of each batch is pickled instead.
+
+    kinds = ('uniform', 'std_normal', 'std_exponential')
+
+    def __init__(self, seed=None, size=65536):
+        import numpy
+        self.generator = numpy.random.default_rng(seed)
+        self.size = size
+        self._start({})
+
+    def _start(self, rest):
+        self._rest = {}  # kind, or slope of a truncated exponential -> iterator over the rest of its batch
+        self._truncated = {}  # slope -> draw, see exponential()
+        for kind in self.kinds:
+            setattr(self, kind, self._chain(kind, rest.get(kind, ())))
+        for slope, values in rest.items():
+            if slope not in self.kinds:
+                self._truncated[slope] = self._chain(slope, values)
+
+    def _chain(self, kind, rest):
+        self._rest[kind] = iter(rest)
+        return chain(self._rest[kind], chain.from_iterable(iter(partial(self._batch, kind), None))).__next__
+
+    def _batch(self, kind):
+        generator = self.generator
+        if kind == 'uniform':
+            values = generator.random(self.size)
+        elif kind == 'std_normal':
+            values = generator.standard_normal(self.size)
+        elif kind == 'std_exponential':
+            values = generator.standard_exponential(self.size)
+        else:
+            # exponential(1, slope) computed for a whole batch of uniforms at once
+            import numpy
+            values = numpy.log1p(math.expm1(kind) * generator.random(self.size)) / kind
+
+        rest = self._rest[kind] = iter(values.tolist())
+        return rest
+
+    def __call__(self):
+        return self.uniform()
+
+    def truncated_exponential(self, slope):
+        draw = self._truncated.get(slope)
+        if draw is None:
+            draw = self._truncated[slope] = self._chain(slope, ())
+        return draw()
+
+    def exponential(self, max=1, slope=25):
+        return max * self.truncated_exponential(slope)
+
+    def __getstate__(self):
+        rest = {kind: list(values) for kind, values in self._rest.items()}
+        self._start(rest)  # reading the rest used it up
+        return {'generator': self.generator, 'size': self.size, 'rest': rest}
+
+    def __setstate__(self, state):
+        self.generator = state['generator']
+        self.size = state['size']
+        self._start(state['rest'])
 
 
-def coin_toss(weight=0.5):
+class Antithetic(Variates):
+    # The antithetic partner of source (random() or a Variates): each variate is the one source would give
+    # with its uniform u replaced by 1 - u, so the two are negatively correlated and the average of a run
+    # and its antithetic twin, from the same seed, varies less than that of two independent runs. Normals
+    # are negated, which is the same thing for Box-Muller with its angle turned half a circle.
+
+    def __init__(self, source):
+        self.source = source
+
+    def __call__(self):
+        return 1 - self.source()
+
+    uniform = __call__
+
+    def std_normal(self):
+        return -std_normal(self.source)
+
+    def std_exponential(self):
+        # From -log(1 - u) to -log(u)
+        u = -math.expm1(-std_exponential(self.source))
+        return -math.log(max(u, sys.float_info.min))
+
+    def truncated_exponential(self, slope):
+        # From log(1 + (e**slope - 1)u)/slope to the same of 1 - u; see exponential()
+        scale = math.expm1(slope)
+        u = math.expm1(slope * exponential(1, slope, self.source)) / scale
+        return math.log1p(scale * (1 - u)) / slope
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def coin_toss(weight=0.5, random=random):
     return random() < weight
 
 
-def std_normal():
+def std_normal(random=random):
+    if isinstance(random, Variates):
+        return random.std_normal()
+
     u = v = 0
     while u == 0:
         u = random()
@@ -19,13 +170,23 @@ def std_normal():
     return math.sqrt(-2.0 * math.log(u)) * math.cos(2.0 * math.pi * v)
 
 
-def exponential(max=1, slope=25):
+def std_exponential(random=random):
+    if isinstance(random, Variates):
+        return random.std_exponential()
+
+    return -math.log(1.0 - random())
+
+
+def exponential(max=1, slope=25, random=random):
     # Sample from an exponential distribution with given maximum value and slope
+    if isinstance(random, Variates):
+        return max * random.truncated_exponential(slope)
+
     return max * math.log(1-(1-math.e**slope)*random())/slope
 
 
-def normal(mean, std):
-    return std_normal() * std + mean
+def normal(mean, std, random=random):
+    return std_normal(random) * std + mean
 
 
 def sigmoid(x, max_x, k=4):
@@ -45,15 +206,38 @@ def sigmoid(x, max_x, k=4):
 
 
 class Request:
-    def __init__(self, key):
+    # Long runs keep a great many of these, so they have fixed slots rather than a __dict__, and the time
+    # spent in each queue has a slot of its own (see Queue.dequeue) rather than a per-request dict.
+    __slots__ = ('key', 'start_ts', 'end_ts', 'tries', 'responded', 'response_type', 'q1_t', 'q2_t',
+                 'queue', 'queue_seq', 'enqueue_ts', 'cache_ts', 'dependency_t', 'path', 'recorded')
+
+    def __init__(self, key, start_ts):
         self.key = key
-        self.start_ts = clock.ts
+        self.start_ts = start_ts
         self.end_ts = None
         self.tries = 0
         self.responded = False
-        self.queue_t = {'q1': 0, 'q2': 0}  # queue position
-        self.queue_p = {'q1': -1, 'q2': -1}
+        self.response_type = None
+        self.q1_t = self.q2_t = 0  # time spent in each queue
+        self.queue = None  # the queue currently holding the request, if any
+        self.queue_seq = -1
+        self.enqueue_ts = None
+        self.cache_ts = None
         self.dependency_t = 0
+        self.path = None  # 'normal' or 'cheap' once admitted, see Admission
+        self.recorded = None  # (latency, result) of its first call to the dependency, from a trace
+
+    @property
+    def queue_t(self):
+        return {'q1': self.q1_t, 'q2': self.q2_t}
+
+    @property
+    def queue_p(self):
+        # Positions shift with every queue operation, so they are worked out when read
+        p = {'q1': -1, 'q2': -1}
+        if self.queue is not None:
+            p[self.queue.name] = self.queue.position(self)
+        return p
 
     def latency(self):
         return self.end_ts - self.start_ts
@@ -63,68 +247,338 @@ class Request:
 
 
 class Queue:
-    def __init__(self, name='Q'):
-        self.items = []
+    # A FIFO queue with O(1) enqueue/dequeue, and the base for the other disciplines. Each entry carries an
+    # enqueue sequence number and requests removed from the middle are left in place as tombstones until
+    # they reach the head, so a position is the distance from the head less the tombstones in between.
+
+    def __init__(self, name, sim):
         self.name = name
+        self.wait_slot = name + '_t'  # where a Request keeps its time in this queue, if anywhere
+        self.sim = sim  # for the clock, the change count and priority()
+        self._entries = deque()  # (seq, r), oldest first
+        self._removed = []  # sorted seqs of the tombstones in _entries
+        self._seq = 0
+        self._size = 0
+
+    @property
+    def items(self):
+        # The queued requests in the order they would be dequeued
+        return [r for seq, r in self._entries if r.queue is self and r.queue_seq == seq]
 
     def remove(self, r):
-        self.items.remove(r)
+        if r.queue is not self:
+            raise ValueError("%s is not in %s" % (r, self.name))
 
-        r.queue_p[self.name] = -1
-        self._update_positions()
+        self.sim.changes += 1
+        r.queue = None
+        self._size -= 1
+        self._discard(r)
 
     def enqueue(self, r):
-        r.enqueue_ts = clock.ts
-        self.items.append(r)
-
-        self._update_positions()
+        self.sim.changes += 1
+        r.enqueue_ts = self.sim.clock.ts
+        r.queue = self
+        r.queue_seq = self._next_seq()
+        self._size += 1
+        self._push(r)
 
     def dequeue(self):
-        r = self.items.pop(0)
-        if r:
-            r.queue_t[self.name] += clock.ts - r.enqueue_ts
-            r.queue_p[self.name] = -1
-            self._update_positions()
+        r = self._pop()
+        self.sim.changes += 1
+        if self.wait_slot:
+            setattr(r, self.wait_slot, getattr(r, self.wait_slot) + self.sim.clock.ts - r.enqueue_ts)
+        r.queue = None
+        self._size -= 1
         return r
 
+    def in_order(self, requests):
+        # The given requests, all in this queue, in the order they would be dequeued
+        return sorted(requests, key=lambda r: r.queue_seq)
+
+    def position(self, r):
+        if r.queue is not self:
+            return -1
+
+        head = self._entries[0][0]
+        return r.queue_seq - head - bisect.bisect_left(self._removed, r.queue_seq)
+
     def full(self, max):
-        return len(self.items) >= max
+        return self._size >= max
 
     def empty(self):
-        return len(self.items) == 0
+        return self._size == 0
+
+    def __len__(self):
+        return self._size
+
+    def _next_seq(self):
+        self._seq += 1
+        return self._seq - 1
+
+    def _push(self, r):
+        self._entries.append((r.queue_seq, r))
+
+    def _pop(self):
+        seq, r = self._entries.popleft()
+        self._trim()
+        return r
+
+    def _discard(self, r):
+        bisect.insort(self._removed, r.queue_seq)
+        self._trim()
+
+    def _trim(self):
+        # Keep the head entry live so position() can measure from it
+        while self._removed and self._entries[0][0] == self._removed[0]:
+            self._entries.popleft()
+            del self._removed[0]
+
+
+class LIFOQueue(Queue):
+    # Serves the most recently enqueued request first. Same tombstone scheme as Queue, measured from the top,
+    # except that tombstones under the top may never surface, so they are also dropped in bulk once they
+    # outnumber the live requests, as in PriorityQueue. Entries stay in enqueue order, so a request is found
+    # by bisecting them on its sequence number.
+
+    def __init__(self, name, sim):
+        super().__init__(name, sim)
+        self._entries = []  # (seq, r), newest last
+
+    @property
+    def items(self):
+        return [r for seq, r in reversed(self._entries) if r.queue is self and r.queue_seq == seq]
+
+    def in_order(self, requests):
+        return sorted(requests, key=lambda r: r.queue_seq, reverse=True)
+
+    def position(self, r):
+        if r.queue is not self:
+            return -1
+
+        below = bisect.bisect_left(self._entries, (r.queue_seq,))
+        above = len(self._removed) - bisect.bisect_right(self._removed, r.queue_seq)
+        return len(self._entries) - 1 - below - above
 
-    def _update_positions(self):
-        for i, r in enumerate(self.items):
-            r.queue_p[self.name] = i
+    def _pop(self):
+        seq, r = self._entries.pop()
+        self._trim()
+        return r
+
+    def _discard(self, r):
+        bisect.insort(self._removed, r.queue_seq)
+        if len(self._removed) > self._size:
+            # Sequence numbers are kept, since Simulation.abandon_due refers to requests by them
+            self._entries = [e for e in self._entries if e[1].queue is self and e[1].queue_seq == e[0]]
+            self._removed = []
+
+        self._trim()
+
+    def _trim(self):
+        while self._removed and self._entries[-1][0] == self._removed[-1]:
+            self._entries.pop()
+            self._removed.pop()
+
+
+class PriorityQueue(Queue):
+    # Serves the request with the highest priority(r) first, FIFO among equals, from a binary heap. Removed
+    # requests are dropped lazily when they surface, or in bulk once they outnumber the live ones. Positions
+    # need a scan of the heap, so they cost O(n) but only when read.
+
+    def __init__(self, name, sim):
+        super().__init__(name, sim)
+        self._entries = []  # heap of (-priority, seq, r)
+        self._dead = 0
+
+    @property
+    def items(self):
+        return [e[2] for e in sorted(self._entries) if self._holds(e)]
+
+    def in_order(self, requests):
+        # By their priority now, which is what they were queued with unless priority() changes its mind
+        return sorted(requests, key=lambda r: (-self.sim.priority(r), r.queue_seq))
+
+    def position(self, r):
+        if r.queue is not self:
+            return -1
+
+        mine = next(e[:2] for e in self._entries if e[2] is r and e[1] == r.queue_seq)
+        return sum(1 for e in self._entries if e[:2] < mine and self._holds(e))
+
+    def _holds(self, entry):
+        return entry[2].queue is self and entry[2].queue_seq == entry[1]
+
+    def _push(self, r):
+        heapq.heappush(self._entries, (-self.sim.priority(r), r.queue_seq, r))
+
+    def _pop(self):
+        r = heapq.heappop(self._entries)[2]
+        self._trim()
+        return r
+
+    def _discard(self, r):
+        self._dead += 1
+        if self._dead > self._size:
+            self._entries = [e for e in self._entries if self._holds(e)]
+            heapq.heapify(self._entries)
+            self._dead = 0
+
+        self._trim()
+
+    def _trim(self):
+        while self._entries and not self._holds(self._entries[0]):
+            heapq.heappop(self._entries)
+            self._dead -= 1
+
+
+disciplines = {'fifo': Queue, 'lifo': LIFOQueue, 'priority': PriorityQueue}
 
 
 class Cache:
-    def __init__(self):
+    # Keeps every entry it is given, forever. The subclasses below bound it; each takes the same arguments
+    # and uses the ones it needs. Entries map a key to the tick it was last written.
+
+    def __init__(self, clock, capacity=0, ttl=0):
+        self.clock = clock
+        self.capacity = capacity
+        self.ttl = ttl
         self.entries = {}
+        self.entry_bytes = 0  # of the keys and values in entries, kept up to date by _set() and _drop_oldest()
+        self.evicted = 0
+        self.expired = 0
 
     def read(self, key):
         if key in self.entries:
             return self.entries[key]
 
     def write(self, key):
-        self.entries[key] = clock.ts
-        evict()
+        self._set(key)
+        self.evict()
 
+    def evict(self):
+        pass
 
-def cache_hit(r):
-    if hasattr(r, 'cache_ts') and r.cache_ts:
-        return cache_age(r) < Server.ttl
+    def footprint(self):
+        # Approximate bytes held by the entries, in O(1) so that stats() can report it
+        return sys.getsizeof(self.entries) + self.entry_bytes
 
+    def _set(self, key):
+        ts = self.clock.ts
+        old = self.entries.get(key)
+        if old is None:
+            self.entry_bytes += sys.getsizeof(key) + sys.getsizeof(ts)
+        else:
+            self.entry_bytes += sys.getsizeof(ts) - sys.getsizeof(old)
+        self.entries[key] = ts
 
-def cache_age(r):
-    if r.responded:
-        return r.end_ts - r.cache_ts
+    def _drop_oldest(self):
+        key, ts = self.entries.popitem(last=False)
+        self.entry_bytes -= sys.getsizeof(key) + sys.getsizeof(ts)
+
+
+class TTLCache(Cache):
+    # Drops entries once they are ttl old, and so of no more use to cache_hit(). Entries are kept in the
+    # order they were written, so expiry only ever looks at the oldest.
+
+    def __init__(self, clock, capacity=0, ttl=0):
+        super().__init__(clock, capacity, ttl)
+        self.entries = OrderedDict()
+
+    def read(self, key):
+        self.expire()
+        return self.entries.get(key)
 
-    return clock.ts - r.cache_ts
+    def write(self, key):
+        self._set(key)
+        self.entries.move_to_end(key)
+        self.expire()
+
+    def expire(self):
+        entries = self.entries
+        cutoff = self.clock.ts - self.ttl
+        while entries and next(iter(entries.values())) <= cutoff:
+            self._drop_oldest()
+            self.expired += 1
+
+
+class LRUCache(Cache):
+    # Holds at most capacity entries, evicting the least recently read or written
 
+    def __init__(self, clock, capacity=0, ttl=0):
+        super().__init__(clock, capacity, ttl)
+        self.entries = OrderedDict()
+
+    def read(self, key):
+        ts = self.entries.get(key)
+        if ts is not None:
+            self.entries.move_to_end(key)
+        return ts
+
+    def write(self, key):
+        self._set(key)
+        self.entries.move_to_end(key)
+        self.evict()
 
-def evict():
-    pass
+    def evict(self):
+        while len(self.entries) > self.capacity:
+            self._drop_oldest()
+            self.evicted += 1
+
+
+class TinyLFUCache(LRUCache):
+    # An LRUCache that, once full, only admits a new key if it has been asked for more often than the entry
+    # it would evict (TinyLFU), or if that entry is already ttl old. Frequencies are estimated by a
+    # count-min sketch of every read, with 4-bit counts halved every 10 * capacity reads so that the
+    # estimate follows changes in popularity.
+
+    _hashes = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+    _halve = bytes(c >> 1 for c in range(256))
+
+    def __init__(self, clock, capacity=0, ttl=0):
+        super().__init__(clock, capacity, ttl)
+        self.width = 1 << max(4, (4 * capacity - 1).bit_length())
+        self.sketch = [bytearray(self.width) for _ in self._hashes]
+        self.samples = 0
+        self.rejected = 0
+
+    def read(self, key):
+        self.record(key)
+        return super().read(key)
+
+    def write(self, key):
+        entries = self.entries
+        if key not in entries and len(entries) >= self.capacity:
+            victim = next(iter(entries))
+            stale = self.clock.ts - entries[victim] >= self.ttl
+            if not stale and self.frequency(key) <= self.frequency(victim):
+                self.rejected += 1
+                return
+
+        super().write(key)
+
+    def record(self, key):
+        h = hash(key)
+        mask = self.width - 1
+        for row, seed in zip(self.sketch, self._hashes):
+            i = ((h * seed) >> 16) & mask
+            if row[i] < 15:
+                row[i] += 1
+
+        self.samples += 1
+        if self.samples >= 10 * self.capacity:
+            for row in self.sketch:
+                row[:] = row.translate(self._halve)
+            self.samples //= 2
+
+    def frequency(self, key):
+        h = hash(key)
+        mask = self.width - 1
+        return min(row[((h * seed) >> 16) & mask] for row, seed in zip(self.sketch, self._hashes))
+
+    def footprint(self):
+        return super().footprint() + sum(sys.getsizeof(row) for row in self.sketch)
+
+
+caches = {'unbounded': Cache, 'ttl': TTLCache, 'lru': LRUCache, 'tinylfu': TinyLFUCache}
 
 
 class Clock:
@@ -134,30 +588,474 @@ class Clock:
     def tick(self):
         self.ts += 1
 
+    def advance(self, ts):
+        self.ts = ts
+
+
+class DependencyHealth:
+    # A running picture of the dependency, built from the calls made to it as they complete: exponentially
+    # weighted moving averages of latency and error rate (weight alpha per call), the same over a sliding
+    # window of ticks (kept as a ring of buckets), and an estimate of the `tail` quantile of latency that
+    # moves a little towards each call (stochastic approximation). Updates are O(1) and memory is fixed, so
+    # strategies can afford to consult it on every tick.
+
+    def __init__(self, alpha=0.05, window=10000, buckets=10, tail=0.99):
+        self.alpha = alpha
+        self.tail_q = tail
+        self.width = max(1, window // buckets)
+        self.buckets = [[-1, 0, 0.0, 0] for _ in range(buckets)]  # [period, calls, total latency, errors]
+        self.calls = 0
+        self.latency = 0
+        self.error_rate = 0
+        self.tail = 0
+        self.spread = 0  # moving average of |latency - self.latency|, to scale the tail's steps
+
+    def record(self, ts, t, result):
+        error = result != 'success'
+        if self.calls == 0:
+            self.latency = self.tail = t
+
+        a = self.alpha
+        self.spread += a * (abs(t - self.latency) - self.spread)
+        self.latency += a * (t - self.latency)
+        self.error_rate += a * (error - self.error_rate)
+        self.tail += a * self.spread * (self.tail_q - (t <= self.tail)) / (1 - self.tail_q) ** 0.5
+        self.calls += 1
+
+        period = ts // self.width
+        b = self.buckets[period % len(self.buckets)]
+        if b[0] != period:
+            b[:] = [period, 0, 0.0, 0]
+        b[1] += 1
+        b[2] += t
+        b[3] += error
+
+    def window(self, ts):
+        # (calls, mean latency, error rate) over the window ending at ts
+        oldest = ts // self.width - len(self.buckets) + 1
+        calls = total = errors = 0
+        for period, n, latency, e in self.buckets:
+            if period >= oldest:
+                calls += n
+                total += latency
+                errors += e
+
+        if not calls:
+            return 0, 0, 0
+        return calls, total/calls, errors/calls
+
+
+class Admission:
+    # Admission control, consulted for each arrival that finds room in q1. Admitted requests are in flight
+    # until they are responded to, down either the normal path, through both pools, or the cheap path, which
+    # is p1's cache read followed straight away by a response (cached or fallback). This policy admits every
+    # request down the normal path; the subclasses limit the number in flight.
+
+    def __init__(self, Server):
+        self.normal = 0  # in flight down each path
+        self.cheap = 0
+        self.limit = math.inf  # on normal requests in flight
+        self.rejected = 0
+
+    def path(self):
+        # 'normal', 'cheap' or None to reject
+        return 'normal' if self.normal < self.limit else None
+
+    def admit(self, r):
+        r.path = self.path()
+        if r.path is None:
+            self.rejected += 1
+            return False
+
+        if r.path == 'normal':
+            self.normal += 1
+        else:
+            self.cheap += 1
+        return True
+
+    def release(self, r):
+        if r.path == 'cheap':
+            self.cheap -= 1
+        else:
+            self.normal -= 1
+            self.update(r)
+
+    def update(self, r):
+        # Called as each normal request is responded to, for the adaptive policies
+        pass
+
+
+class StaticAdmission(Admission):
+    # The usual load shedding: at most Cmax (admission_limit) requests in flight
+
+    def __init__(self, Server):
+        super().__init__(Server)
+        self.limit = Server.admission_limit
+
+
+class TwoThresholdAdmission(Admission):
+    # Up to C1 (admission_normal) requests in flight down the normal path and, beyond those, up to C2 down the
+    # cheap path, where C2 is what is left of Cmax (admission_limit) at admission_cheap_cost per cheap
+    # request, so that C1 + C2 * cost = Cmax
+
+    def __init__(self, Server):
+        super().__init__(Server)
+        self.limit = Server.admission_normal
+        self.cheap_limit = int((Server.admission_limit - self.limit) / Server.admission_cheap_cost + 1e-9)
+
+    def path(self):
+        if self.normal < self.limit:
+            return 'normal'
+        if self.cheap < self.cheap_limit:
+            return 'cheap'
+        return None
+
+
+class AIMDAdmission(Admission):
+    # An adaptive limit after the AIMD limit in Netflix's concurrency-limits, wrapped in a WindowedLimit as
+    # there: responses are taken `window` at a time, and for each window the limit is cut by `backoff` if any
+    # was a drop (slower than admission_latency), and otherwise grows by one if at least half of it is in
+    # use. It starts at admission_limit and stays within admission_min and admission_max.
+
+    window = 10
+    backoff = 0.9
+
+    def __init__(self, Server):
+        super().__init__(Server)
+        self.limit = Server.admission_limit
+        self.min = Server.admission_min
+        self.max = Server.admission_max
+        self.max_latency = Server.admission_latency
+        self.samples = 0
+        self.total_latency = 0
+        self.dropped = False
+
+    def update(self, r):
+        latency = r.latency()
+        self.samples += 1
+        self.total_latency += latency
+        self.dropped = self.dropped or latency > self.max_latency
+        if self.samples >= self.window:
+            limit = self.adjust(self.total_latency/self.samples, self.dropped)
+            self.limit = max(self.min, min(self.max, limit))
+            self.samples = self.total_latency = 0
+            self.dropped = False
+
+    def utilized(self):
+        # Too little in flight says nothing about whether the limit could be higher
+        return 2 * self.normal >= self.limit
+
+    def adjust(self, latency, dropped):
+        if dropped:
+            return self.limit * self.backoff
+        if self.utilized():
+            return self.limit + 1
+        return self.limit
+
+
+class GradientAdmission(AIMDAdmission):
+    # An adaptive limit after the gradient limits in Netflix's concurrency-limits, which compare the latest
+    # latency (here a window's mean) with the latency without load: the limit shrinks, by up to half, as
+    # latency rises above `tolerance` times that, and otherwise grows by a margin of sqrt(limit), with
+    # smoothing. The latency without load is the lowest seen, except that it follows the latest while too
+    # little is in flight for there to be any load, so that it can follow a dependency that gets slower.
+
+    tolerance = 1.0
+    smoothing = 0.2
+    drift = 0.1
+
+    def __init__(self, Server):
+        super().__init__(Server)
+        self.base_latency = None
+
+    def adjust(self, latency, dropped):
+        latency = max(latency, 1)
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        elif not self.utilized():
+            self.base_latency += self.drift * (latency - self.base_latency)
+
+        if not self.utilized():
+            return self.limit
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.base_latency / latency))
+        limit = self.limit * gradient + math.sqrt(self.limit)
+        return self.limit * (1 - self.smoothing) + limit * self.smoothing
+
+
+admissions = {'none': Admission, 'static': StaticAdmission, 'two-threshold': TwoThresholdAdmission,
+              'aimd': AIMDAdmission, 'gradient': GradientAdmission}
+
+#
+# Arrivals
+#
+
+
+class PeriodicArrivals:
+    # One request every Client.rate ticks, with keys from the simulation's sample(). An arrival process gives
+    # the first tick after a given one on which there are arrivals (None if there are no more) and the
+    # requests arriving on a tick, and is asked for the latter on every tick in 'tick' mode.
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def next_ts(self, ts):
+        rate = self.sim.Client.rate
+        return (ts // rate + 1) * rate
+
+    def arrivals(self, ts):
+        if ts % self.sim.Client.rate:
+            return ()
+        return (Request(self.sim.sample(), ts),)
+
+
+class TraceArrivals:
+    # Replays the requests recorded in the trace at Client.trace (see read_trace()), its first on the first
+    # tick and the rest Client.trace_scale ticks apart per unit of the trace's ts. Requests with a recorded
+    # latency and result have their first call to the dependency take that long and end that way, unless it
+    # runs past Dependency.timeout (see Simulation.replay); any retries are drawn from dependency() as usual.
+    # The trace is read as it is needed, so memory stays constant however long it is. Snapshots keep the
+    # number of records read and skip them on restore.
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.path = sim.Client.trace
+        self.scale = sim.Client.trace_scale
+        self.read = 0
+        self.t0 = None  # the trace's first ts
+        self._open()
+
+    def _open(self):
+        self.records = read_trace(self.path, self.read)
+        self._next()
+
+    def _next(self):
+        self.pending = next(self.records, None)
+        if self.pending is not None:
+            if self.t0 is None:
+                self.t0 = self.pending[0]
+            self.pending_ts = 1 + math.floor((self.pending[0] - self.t0) * self.scale)
+
+    def next_ts(self, ts):
+        if self.pending is None:
+            return None
+        return max(ts + 1, self.pending_ts)
+
+    def arrivals(self, ts):
+        requests = []
+        while self.pending is not None and self.pending_ts <= ts:
+            t, key, latency, result = self.pending
+            r = Request(key, ts)
+            if result is not None:
+                r.recorded = (latency, result)
+            requests.append(r)
+            self.read += 1
+            self._next()
+        return requests
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['records'], state['pending']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+class PoissonArrivals(PeriodicArrivals):
+    # Arrivals at exponentially distributed intervals averaging Client.rate ticks, so that several can fall
+    # on the same tick. Each interval is drawn with the rate in force when the one before it ended, so a
+    # configure() that changes Client.rate over time (to follow a daily cycle, say) takes effect from the next
+    # arrival. With Engine.variates = 'numpy' the intervals come from NumPy in batches.
+
+    def __init__(self, sim):
+        super().__init__(sim)
+        self.t = 0.0  # when the next arrival (or batch) is due
+        self._next()
+
+    def _next(self):
+        self.t += self.sim.Client.rate * self.gap()
+        self.pending_ts = max(1, math.ceil(self.t))
+
+    def gap(self):
+        # Until the next arrival, in units of Client.rate
+        return self.sim.draw_arrivals.std_exponential()
+
+    def batch(self):
+        return 1
+
+    def next_ts(self, ts):
+        return max(ts + 1, self.pending_ts)
+
+    def arrivals(self, ts):
+        requests = []
+        while self.pending_ts <= ts:
+            for _ in range(self.batch()):
+                requests.append(Request(self.sim.sample(), ts))
+            self._next()
+        return requests
+
+
+class BurstArrivals(PoissonArrivals):
+    # Bursts of Client.burst_size requests at once, at exponentially distributed intervals such that requests
+    # still arrive every Client.rate ticks on average
+
+    def gap(self):
+        return self.sim.Client.burst_size * self.sim.draw_arrivals.std_exponential()
+
+    def batch(self):
+        return self.sim.Client.burst_size
+
+
+class MMPPArrivals(PoissonArrivals):
+    # A Markov-modulated Poisson process: it goes through the states in Client.mmpp in turn, staying in each
+    # for an exponentially distributed time with the given mean, and in each state requests arrive as a
+    # Poisson process with the given relative rate. Rates are scaled so that requests still arrive every
+    # Client.rate ticks on average. The default's two states make on/off bursts.
+
+    def __init__(self, sim):
+        states = sim.Client.mmpp
+        self.scale = sum(ticks * rate for ticks, rate in states) / sum(ticks for ticks, rate in states)
+        self.state = 0
+        self.state_end = states[0][0] * sim.draw_arrivals.std_exponential()
+        super().__init__(sim)
+
+    def _next(self):
+        states = self.sim.Client.mmpp
+        while True:
+            ticks, rate = states[self.state]
+            if rate:
+                gap = self.sim.draw_arrivals.std_exponential()
+                t = self.t + self.sim.Client.rate * self.scale / rate * gap
+                if t <= self.state_end:
+                    break
+
+            # Intervals are memoryless, so the next state can start afresh
+            self.t = self.state_end
+            self.state = (self.state + 1) % len(states)
+            self.state_end = self.t + states[self.state][0] * self.sim.draw_arrivals.std_exponential()
+
+        self.t = t
+        self.pending_ts = max(1, math.ceil(t))
+
+
+class DiurnalArrivals(PoissonArrivals):
+    # A Poisson process whose rate follows a sine wave over Client.diurnal_period ticks, from 1 - amplitude to
+    # 1 + amplitude times the average of one request every Client.rate ticks (Client.diurnal_amplitude). It
+    # is generated by thinning: candidates arrive at the peak rate and are kept in proportion to the rate at
+    # the time.
+
+    def _next(self):
+        Client = self.sim.Client
+        peak = 1 + Client.diurnal_amplitude
+        while True:
+            self.t += Client.rate / peak * self.sim.draw_arrivals.std_exponential()
+            rate = 1 + Client.diurnal_amplitude * math.sin(2 * math.pi * self.t / Client.diurnal_period)
+            if self.sim.draw_arrivals.uniform() * peak < rate:
+                break
+
+        self.pending_ts = max(1, math.ceil(self.t))
+
+
+arrival_processes = {'periodic': PeriodicArrivals, 'trace': TraceArrivals, 'poisson': PoissonArrivals,
+                     'burst': BurstArrivals, 'mmpp': MMPPArrivals, 'diurnal': DiurnalArrivals}
+
+
+# Binary traces are fixed-size records: ts (double), key (int64), latency (double, NaN if not recorded) and
+# result (int8, an index into _trace_results or -1 if not recorded), little-endian and unpadded
+_trace_record = struct.Struct('<dqdb')
+_trace_results = ('success', 'failure', 'timeout')
+
+
+def read_trace(path, start=0):
+    # Yields (ts, key, latency, result) for each record of a trace after the first `start`, in order of ts.
+    # A trace is either a binary file written by write_trace() or, if path ends in .csv, a CSV file whose
+    # header names a ts and a key column and, optionally, latency and result columns ('success', 'failure'
+    # or 'timeout'); latency and result are None unless both are recorded. Keys that are whole numbers are
+    # read as ints. Files are streamed, or memory-mapped in the binary case, rather than read whole.
+    if path.endswith('.csv'):
+        return _read_csv_trace(path, start)
+    return _read_binary_trace(path, start)
+
+
+def _read_csv_trace(path, start):
+    with open(path, newline='') as f:
+        rows = csv.reader(f)
+        columns = next(rows)
+        ts, key = columns.index('ts'), columns.index('key')
+        latency = columns.index('latency') if 'latency' in columns else None
+        result = columns.index('result') if 'result' in columns else None
+
+        for i, row in enumerate(rows):
+            if i < start or not row:
+                continue
+            k = row[key]
+            recorded = None not in (latency, result) and '' not in (row[latency], row[result])
+            yield (float(row[ts]), int(k) if k.isdigit() else k,
+                   float(row[latency]) if recorded else None, row[result] if recorded else None)
+
+
+def _read_binary_trace(path, start):
+    with open(path, 'rb') as f:
+        if not f.seek(0, 2):
+            return  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            size = _trace_record.size
+            for offset in range(start * size, len(m) - size + 1, size):
+                ts, key, latency, result = _trace_record.unpack_from(m, offset)
+                if result < 0:
+                    yield ts, key, None, None
+                else:
+                    yield ts, key, latency, _trace_results[result]
+
+
+def write_trace(path, records):
+    # Writes (ts, key, latency, result) records, e.g. from read_trace() of a CSV trace, as a binary trace.
+    # Keys must be ints.
+    with open(path, 'wb') as f:
+        for ts, key, latency, result in records:
+            if result is None:
+                f.write(_trace_record.pack(ts, key, math.nan, -1))
+            else:
+                f.write(_trace_record.pack(ts, key, latency, _trace_results.index(result)))
+
 #
 # Pools and workers
 #
 
 
 class P1Worker:
-    def __init__(self, r):
+    def __init__(self, sim, r):
         self.r = r
-        self.r.cache_ts = cache.read(r.key)
-        enqueue_or_respond(q2, self.r)
+        self.r.cache_ts = sim.cache.read(r.key)
+        if r.path == 'cheap':
+            sim.respond(self.r)
+        else:
+            sim.enqueue_or_respond(sim.q2, self.r)
 
     def is_done(self):
         return self.r.responded
 
 
 class P2Worker:
-    def __init__(self, r):
+    def __init__(self, sim, r):
+        self.sim = sim
         self.r = r
-        t, self.result = dependency()
-        self.r.dependency_t += t
-        self.done_at_ts = clock.ts + t
+        if r.recorded:
+            self.t, self.result = sim.replay(r)
+        else:
+            self.t, self.result = sim.dependency()
+        self.r.dependency_t += self.t
+        self.done_at_ts = sim.clock.ts + self.t
+        sim.schedule(self.done_tick(), 'completion')
+
+    def done_tick(self):
+        # The first tick from now on which is_done() holds; workers are first checked on the tick after dispatch
+        return max(self.sim.clock.ts + 1, math.ceil(self.done_at_ts))
 
     def is_done(self):
-        return clock.ts >= self.done_at_ts
+        return self.sim.clock.ts >= self.done_at_ts
 
 
 def complete(workers):
@@ -174,6 +1072,13 @@ def not_complete(workers):
 
 class Client:
     rate = 25  # ticks/request  # 33 reqs/sec
+    arrivals = 'periodic'  # see arrival_processes
+    trace = None  # path of the trace to replay for 'trace' arrivals
+    trace_scale = 1  # ticks per unit of the trace's ts
+    burst_size = 5  # for 'burst' arrivals
+    mmpp = ((2000, 4), (6000, 0))  # for 'mmpp' arrivals: (mean ticks, relative rate) of each state
+    diurnal_period = 200000  # for 'diurnal' arrivals, in ticks
+    diurnal_amplitude = 0.5
     key_space = 50000          # normal(1000,50)
     decay_k = 3
     decay_max = 400
@@ -191,6 +1096,17 @@ class Server:
     q2_max = 10  # 12
     ttl = 300000  # 10000
     tries = 1    # 0
+    q1_discipline = 'fifo'  # see disciplines
+    q2_discipline = 'fifo'
+    cache_policy = 'unbounded'  # see caches
+    cache_size = 10000  # for the bounded policies
+    admission = 'none'  # see admissions
+    admission_limit = 20  # Cmax; where the adaptive policies start from
+    admission_normal = 20  # C1, for 'two-threshold'
+    admission_cheap_cost = 0.25  # of a cheap request, relative to a normal one
+    admission_min = 1  # bounds on the adaptive limits
+    admission_max = 200
+    admission_latency = 200  # for 'aimd', slower responses count as drops
 
 
 class Dependency:
@@ -199,64 +1115,200 @@ class Dependency:
     availability = 0.98
     timeout = 175
 
+
+class Engine:
+    # 'tick' runs every tick; 'event' jumps the clock between arrivals, p2 completions, the ticks revisit()
+    # asks for and the follow-up tick after any tick that changed state. Both give the same results, but in
+    # 'event' mode configure() and abandon() are only consulted on those ticks, so hooks that depend on the
+    # passage of time alone need 'tick' mode (or, for abandon(), a revisit() that says when).
+    mode = 'event'
+    variates = 'python'  # or 'numpy' to draw in batches through a Variates
+    keep_requests = True  # keep created and completed requests; stats() and report() do not need them
+    profile = False  # time the phases of step() and the strategies into a Profile; see Simulation.profile
+    export = None  # directory to write every response to as it is made, column by column; see RequestExport
+    export_chunk = 65536  # responses held in memory between writes
+
+
+def configuration(source, **overrides):
+    # A private copy of a configuration class (or of an earlier copy) with the given settings changed, so that
+    # a simulation is unaffected by later changes to the module-level settings
+    cls = source if isinstance(source, type) else type(source)
+    config = cls()
+    for k, v in list(vars(cls).items()) + list(vars(source).items()) + list(overrides.items()):
+        if k.startswith('_'):
+            continue
+        if not hasattr(cls, k):
+            raise AttributeError("%s has no setting '%s'" % (cls.__name__, k))
+        setattr(config, k, v)
+
+    return config
+
+
 #
-# Overridable functions
+# Report
 #
 
 
-def configure():
-    pass
+class Tally:
+    # Running count, sum and sum of squares of a metric
+    __slots__ = ('n', 'sum', 'sumsq')
 
+    def __init__(self, n=0, sum=0, sumsq=0):
+        self.n = n
+        self.sum = sum
+        self.sumsq = sumsq
 
-def abandon(r):
-    # if r.tries >= 1 and cache_hit(r):
-    #   return 'reneg'
+    def add(self, x):
+        self.n += 1
+        self.sum += x
+        self.sumsq += x * x
 
-    if cache_hit(r) or r.tries >= Server.tries:
-        return "reneg"
+    def mean(self):
+        return self.sum/self.n if self.n else 0
 
-    return 'wait'
+    def var(self):
+        if self.n < 2:
+            return 0
+        return max(0, (self.sumsq - self.sum * self.sum/self.n)/(self.n - 1))
 
+    def __add__(self, other):
+        return Tally(self.n + other.n, self.sum + other.sum, self.sumsq + other.sumsq)
 
-def response(r):
-    return "cached" if cache_hit(r) else "fallback"
+    def __sub__(self, other):
+        return Tally(self.n - other.n, self.sum - other.sum, self.sumsq - other.sumsq)
 
 
-def qos(r):
-    if r.response_type == 'rejected':
-        value = Client.rejected
-    elif r.response_type == 'live':
-        value = Client.live
-    elif r.response_type == 'fallback':
-        value = Client.fallback
-    else:
-        value = sigmoid(cache_age(r), Client.cache_age_max, Client.cache_age_k)
+class Histogram:
+    # Counts values in log-spaced buckets, each `growth` times as wide as the one before (HDR histogram
+    # style), so quantiles are within about (growth - 1)/2 relative error whatever the number of values, and
+    # memory grows only with the log of the range of values. Values below 1 share a bucket that reads as 0.
+    # Histograms add and subtract bucket-wise, so those from separate runs can be merged.
+    __slots__ = ('counts', 'n')
 
-    return value * sigmoid(r.latency(), Client.decay_max, Client.decay_k)
+    growth = 1.01
+    _log_growth = math.log(growth)
 
+    def __init__(self, counts=None):
+        self.counts = counts or {}  # bucket -> count
+        self.n = sum(self.counts.values())
 
-def sample():
-    return int(exponential(Client.key_space))
+    def add(self, x):
+        b = int(math.log(x) / Histogram._log_growth) + 1 if x >= 1 else 0
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.n += 1
 
+    def quantile(self, q):
+        if not self.n:
+            return 0
 
-def dependency():
-    t = normal(Dependency.mean, Dependency.std)
-    if t > Dependency.timeout:
-        return Dependency.timeout, 'timeout'
+        rank = q * self.n
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                return Histogram.growth ** (b - 0.5) if b else 0
 
-    return t, 'success' if (coin_toss(Dependency.availability)) else 'failure'
+    def __add__(self, other):
+        counts = dict(self.counts)
+        for b, c in other.counts.items():
+            counts[b] = counts.get(b, 0) + c
+        return Histogram(counts)
 
+    def __sub__(self, other):
+        counts = dict(self.counts)
+        for b, c in other.counts.items():
+            counts[b] -= c
+        return Histogram({b: c for b, c in counts.items() if c})
 
-def priority(r):
-    return 1
 
-#
-# Report
-#
+class Totals:
+    # Running tallies of the report metrics per response type, kept up to date as requests are responded
+    # to, so that stats() and report() cost nothing like a pass over the requests and need not keep them.
+    # The time metrics also have a Histogram each, for percentiles. Totals from separate runs can be added.
 
+    metrics = ('qos', 'tries', 'latency', 'q1', 'q2', 'dependency')
+    timings = ('latency', 'q1', 'q2', 'dependency')
+    percentiles = (50, 95, 99)
 
-def _by_type(reqs, response_type):
-    return [r for r in completed if r.response_type == response_type]
+    def __init__(self):
+        self.types = {}  # response type -> {metric: Tally}
+        self.histograms = {}  # response type -> {timing: Histogram}
+        self.served = 0  # responses other than 'rejected'
+        self.hits = 0  # of those, cache hits
+        self.entries = 0  # of those, with a cache entry
+
+    def add(self, r, qos, hit):
+        tallies = self.types.get(r.response_type)
+        if tallies is None:
+            tallies = self.types[r.response_type] = {m: Tally() for m in self.metrics}
+            self.histograms[r.response_type] = {m: Histogram() for m in self.timings}
+
+        latency = r.latency()
+        tallies['qos'].add(qos)
+        tallies['tries'].add(r.tries)
+        tallies['latency'].add(latency)
+        tallies['q1'].add(r.q1_t)
+        tallies['q2'].add(r.q2_t)
+        tallies['dependency'].add(r.dependency_t)
+
+        histograms = self.histograms[r.response_type]
+        histograms['latency'].add(latency)
+        histograms['q1'].add(r.q1_t)
+        histograms['q2'].add(r.q2_t)
+        histograms['dependency'].add(r.dependency_t)
+
+        if r.response_type != 'rejected':
+            self.served += 1
+            if hit:
+                self.hits += 1
+            if r.cache_ts:
+                self.entries += 1
+
+    def combined(self, types=None):
+        # {metric: Tally} over the given response types, all of them by default
+        combined = {m: Tally() for m in self.metrics}
+        for t, tallies in self.types.items():
+            if types is None or t in types:
+                for m in self.metrics:
+                    combined[m] = combined[m] + tallies[m]
+        return combined
+
+    def combined_histograms(self, types=None):
+        combined = {m: Histogram() for m in self.timings}
+        for t, histograms in self.histograms.items():
+            if types is None or t in types:
+                for m in self.timings:
+                    combined[m] = combined[m] + histograms[m]
+        return combined
+
+    def stats(self, types=None):
+        tallies = self.combined(types)
+        s = {'count': tallies['qos'].n}
+        s.update((m, tallies[m].mean()) for m in self.metrics)
+
+        latency = self.combined_histograms(types)['latency']
+        s.update(('latency_p%d' % p, latency.quantile(p/100)) for p in self.percentiles)
+        return s
+
+    def __add__(self, other):
+        return self._combine(other, lambda a, b: a + b)
+
+    def __sub__(self, other):
+        # The totals accumulated since other, an earlier copy
+        return self._combine(other, lambda a, b: a - b)
+
+    def _combine(self, other, op):
+        result = Totals()
+        for t in set(self.types) | set(other.types):
+            for attr, cls, names in (('types', Tally, self.metrics), ('histograms', Histogram, self.timings)):
+                mine = getattr(self, attr).get(t, {})
+                theirs = getattr(other, attr).get(t, {})
+                getattr(result, attr)[t] = {m: op(mine.get(m, cls()), theirs.get(m, cls())) for m in names}
+
+        result.served = op(self.served, other.served)
+        result.hits = op(self.hits, other.hits)
+        result.entries = op(self.entries, other.entries)
+        return result
 
 
 def _avg(values):
@@ -265,11 +1317,41 @@ def _avg(values):
     return sum(values)/len(values)
 
 
+# Two-sided 95% quantiles of Student's t for 1..30 degrees of freedom
+_T95 = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23, 2.20, 2.18, 2.16, 2.14, 2.13,
+        2.12, 2.11, 2.10, 2.09, 2.09, 2.08, 2.07, 2.07, 2.06, 2.06, 2.06, 2.05, 2.05, 2.05, 2.04]
+
+
+def _interval(values):
+    # Mean and 95% confidence half-width, treating values (batch means) as independent
+    n = len(values)
+    mean = _avg(values)
+    if n < 2:
+        return mean, math.inf
+
+    var = sum((v - mean)**2 for v in values)/(n - 1)
+    t = _T95[n - 2] if n - 1 <= len(_T95) else 1.96
+    return mean, t * math.sqrt(var/n)
+
+
+def _steady(batches, metrics, tolerance):
+    # Whether the first and second halves of the batches agree on every metric, to within tolerance
+    # (relative) or the noise between batches, whichever is larger
+    half = len(batches)//2
+    for m in metrics:
+        old_mean, old_h = _interval([b[m] for b in batches[:half]])
+        new_mean, new_h = _interval([b[m] for b in batches[half:]])
+        if abs(new_mean - old_mean) > max(tolerance * abs(old_mean), math.hypot(old_h, new_h)):
+            return False
+
+    return True
+
+
 def _avg_latency(reqs):
     return _avg([r.latency() for r in reqs])
 
 
-def _avg_qos(reqs):
+def _avg_qos(reqs, qos):
     return _avg([qos(r) for r in reqs])
 
 
@@ -278,7 +1360,8 @@ def _avg_tries(reqs):
 
 
 def _avg_queue_t(reqs, q_name):
-    return _avg([r.queue_t[q_name] for r in reqs])
+    slot = q_name + '_t'
+    return _avg([getattr(r, slot) for r in reqs])
 
 
 def _avg_dep_t(reqs):
@@ -292,155 +1375,983 @@ def _stats_header():
     print('-' * 57)
 
 
-def _stats_row(label, reqs):
+def _stats_row(label, s):
     print("%9s %5d %6.2f %6.1f %6.1f %6.1f %6.1f %6.1f" %
-          (label, len(reqs),
-           _avg_qos(reqs),
-           _avg_tries(reqs),
-           _avg_latency(reqs),
-           _avg_queue_t(reqs, 'q1'),
-           _avg_queue_t(reqs, 'q2'),
-           _avg_dep_t(reqs)))
+          (label, s['count'], s['qos'], s['tries'], s['latency'], s['q1'], s['q2'], s['dependency']))
 
 
-def stats(reqs=None):
-    if not reqs:
-        reqs = completed
-
-    return {
-        'count': len(reqs),
-        'qos': _avg_qos(reqs),
-        'tries': _avg_tries(reqs),
-        'latency': _avg_latency(reqs),
-        'q1': _avg_queue_t(reqs, 'q1'),
-        'q2': _avg_queue_t(reqs, 'q2'),
-        'dependency': _avg_dep_t(reqs)}
-
-
-def report():
-    # Leaving this as an inefficient bunch of loops until we know what we want to report
-    _stats_header()
-    _stats_row('all', completed)
-
-    for t in ['rejected', 'cached', 'live', 'fallback']:
-        _stats_row(t, _by_type(completed, t))
+def _percentiles_header():
+    print('-' * 57)
+    print("%9s %6s %6s %6s %6s %6s %6s" %
+          ('type', 'p50', 'p95', 'p99', 'q1 p99', 'q2 p99', 'dep p99'))
+    print('-' * 57)
 
-    print()
 
-    if Server.ttl > 0:
-        reqs = [r for r in completed if r.response_type != 'rejected']
-        hits = [r for r in reqs if cache_hit(r)]
-        print("cache hits %d/%d = %.2f" %
-              (len(hits), len(reqs), len(hits)/len(reqs)))
-        hits = [r for r in reqs if r.cache_ts]
-        print("   entries %d/%d = %.2f" %
-              (len(hits), len(reqs), len(hits)/len(reqs)))
+def _percentiles_row(label, histograms):
+    latency = histograms['latency']
+    print("%9s %6.1f %6.1f %6.1f %6.1f %6.1f %6.1f" %
+          (label, latency.quantile(0.5), latency.quantile(0.95), latency.quantile(0.99),
+           histograms['q1'].quantile(0.99),
+           histograms['q2'].quantile(0.99),
+           histograms['dependency'].quantile(0.99)))
 
 #
-# Main loop
+# Profiling
 #
 
 
-def enqueue_or_respond(q2, r):
-    if q2.full(Server.q2_max):
-        respond(r)  # essentially the eviction case
-        # print("%d %s" % (clock.ts, r.response_type))
+class Profile:
+    # Where a run's time goes, collected when Engine.profile is set: calls, seconds and items handled (p2
+    # completions, p1 dispatches, requests scanned for abandonment, p2 dispatches, arrivals) per phase of
+    # step(); calls and seconds per strategy; and the ticks and steps main() gets through per second. In
+    # 'event' mode a step is an event handled; in 'tick' mode it is a tick. Timings include the overhead of
+    # taking them, which matters next to a trivial strategy but not next to a phase. Profiles of separate
+    # runs can be added, and as_dict() is what save() writes as JSON, for comparing runs.
 
-    else:
-        q2.enqueue(r)
+    phases = ('complete_p2', 'dispatch_p1', 'abandon_q2', 'dispatch_p2', 'arrive')
 
+    def __init__(self):
+        self.steps = {name: [0, 0.0, 0] for name in self.phases}  # phase -> [calls, seconds, items]
+        self.hooks = {}  # strategy -> [calls, seconds]
+        self.ticks = 0
+        self.events = 0
+        self.seconds = 0.0  # in main()
+
+    def hook(self, name, seconds):
+        timing = self.hooks.get(name)
+        if timing is None:
+            timing = self.hooks[name] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+
+    def as_dict(self):
+        seconds = self.seconds or math.inf
+        return {
+            'ticks': self.ticks,
+            'events': self.events,
+            'seconds': self.seconds,
+            'ticks_per_second': self.ticks / seconds,
+            'events_per_second': self.events / seconds,
+            'phases': {name: {'calls': calls, 'seconds': t, 'items': items}
+                       for name, (calls, t, items) in self.steps.items()},
+            'hooks': {name: {'calls': calls, 'seconds': t} for name, (calls, t) in self.hooks.items()}}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def report(self):
+        d = self.as_dict()
+        print("%d ticks, %d events in %.2fs: %.0f ticks/s, %.0f events/s" %
+              (self.ticks, self.events, self.seconds, d['ticks_per_second'], d['events_per_second']))
+        print('-' * 57)
+        print("%14s %10s %9s %6s %10s %5s" % ('phase/hook', 'calls', 'seconds', '%', 'items', 'us'))
+        print('-' * 57)
+        rows = [(name, calls, t, items) for name, (calls, t, items) in self.steps.items()]
+        rows += [(name, calls, t, '') for name, (calls, t) in sorted(self.hooks.items())]
+        for name, calls, t, items in rows:
+            print("%14s %10d %9.3f %6.1f %10s %5.1f" %
+                  (name, calls, t, 100 * t / (self.seconds or math.inf), items, 1e6 * t / (calls or 1)))
+
+    def __add__(self, other):
+        result = Profile()
+        for name in self.phases:
+            result.steps[name] = [a + b for a, b in zip(self.steps[name], other.steps[name])]
+        for name in set(self.hooks) | set(other.hooks):
+            result.hooks[name] = [a + b for a, b in zip(self.hooks.get(name, [0, 0.0]),
+                                                        other.hooks.get(name, [0, 0.0]))]
+        result.ticks = self.ticks + other.ticks
+        result.events = self.events + other.events
+        result.seconds = self.seconds + other.seconds
+        return result
+
+
+class _Timed:
+    # A strategy that times its calls into its simulation's profile; a class rather than a closure so that
+    # profiled simulations can still be pickled
+    def __init__(self, sim, name, fn):
+        self.sim = sim
+        self.name = name
+        self.fn = fn
 
-def respond(r, response_type=None):
-    if not r.responded:
-        r.response_type = response_type if response_type else response(r)
-        r.end_ts = clock.ts
-        r.responded = True
-        completed.append(r)
+    def __call__(self, *args):
+        start = perf_counter()
+        result = self.fn(*args)
+        self.sim.profile.hook(self.name, perf_counter() - start)
+        return result
 
+#
+# Export
+#
 
-def main(ticks):
-    global p1, p2
 
-    while clock.ts < ticks:
-        clock.tick()
-        configure()
+class RequestExport:
+    # Per-request records as columns, one NumPy .npy file each in the directory at path, written a chunk of
+    # responses at a time so that memory stays flat however long the run. The headers are rewritten with
+    # each chunk, so the files are complete after every flush() (the simulation flushes at the end of each
+    # main()), and load_requests() maps them into memory rather than reading them. Writing only needs the
+    # standard library; loading needs NumPy. Response types are stored as codes, listed in meta.json.
+
+    columns = (('key', 'q'), ('start_ts', 'd'), ('end_ts', 'd'), ('tries', 'i'), ('response_type', 'b'),
+               ('q1', 'd'), ('q2', 'd'), ('dependency', 'd'), ('cache_age', 'd'), ('qos', 'd'))
+    header_size = 128  # room for any shape, so that the header can be rewritten in place
+
+    def __init__(self, path, chunk=65536):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk = chunk
+        self.types = ['rejected', 'cached', 'live', 'fallback']  # code -> response type
+        self.codes = {t: code for code, t in enumerate(self.types)}
+        self.count = 0  # written so far
+        self.buffers = {name: array(typecode) for name, typecode in self.columns}
+        for name, typecode in self.columns:
+            with open(self._file(name), 'wb') as f:
+                f.write(self._header(typecode, 0))
+        self._write_meta()
+
+    def add(self, r, qos, cache_age):
+        # Checked before anything is written, as keys from a CSV trace are only ints where they are whole
+        # numbers
+        try:
+            key = operator.index(r.key)
+        except TypeError:
+            raise TypeError("Engine.export needs integer keys, not %r" % (r.key,)) from None
+
+        code = self.codes.get(r.response_type)
+        if code is None:
+            code = self.codes[r.response_type] = len(self.types)
+            self.types.append(r.response_type)
+
+        b = self.buffers
+        b['key'].append(key)
+        b['start_ts'].append(r.start_ts)
+        b['end_ts'].append(r.end_ts)
+        b['tries'].append(r.tries)
+        b['response_type'].append(code)
+        b['q1'].append(r.q1_t)
+        b['q2'].append(r.q2_t)
+        b['dependency'].append(r.dependency_t)
+        b['cache_age'].append(cache_age)
+        b['qos'].append(qos)
+        if len(b['key']) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        n = len(self.buffers['key'])
+        if not n:
+            return
+
+        for name, typecode in self.columns:
+            buffer = self.buffers[name]
+            with open(self._file(name), 'r+b') as f:
+                f.seek(0, os.SEEK_END)
+                buffer.tofile(f)
+                f.seek(0)
+                f.write(self._header(typecode, self.count + n))
+            del buffer[:]
+
+        self.count += n
+        self._write_meta()
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    def _header(self, typecode, n):
+        # Version 1.0 of the .npy format, for a 1-d array of n items in the machine's byte order
+        size = array(typecode).itemsize
+        order = '|' if size == 1 else '<' if sys.byteorder == 'little' else '>'
+        kind = 'f' if typecode == 'd' else 'i'
+        header = "{'descr': '%s%s%d', 'fortran_order': False, 'shape': (%d,), }" % (order, kind, size, n)
+        header = header.ljust(self.header_size - 11) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'count': self.count, 'columns': [name for name, typecode in self.columns],
+                       'types': self.types}, f)
+
+
+def load_requests(path):
+    # The columns written by a RequestExport, as read-only memory-mapped NumPy arrays by name, and the
+    # response types that the codes in 'response_type' stand for, e.g.
+    #   columns, types = load_requests(path)
+    #   live = columns['response_type'] == types.index('live')
+    #   columns['end_ts'][live] - columns['start_ts'][live]
+    import numpy
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    columns = {name: numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['columns']}
+    return columns, meta['types']
 
+#
+# Simulation
+#
+
+
+class Simulation:
+    # Owns everything a run touches (clock, queues, pools, cache, settings and strategies), so independent
+    # simulations can share a process or be sent to worker processes. Settings are copied from the given
+    # configuration classes, the module-level ones by default. A strategy can be replaced by passing a
+    # callable with the same signature as the module-level function of that name (or later, to replace()),
+    # or by overriding the method in a subclass. Given a seed, the default strategies draw from private random sources, one per
+    # source of randomness (see reseed()).
+
+    strategies = ('configure', 'abandon', 'revisit', 'response', 'qos', 'sample', 'dependency', 'priority')
+
+    random_sources = ('arrivals', 'keys', 'latency', 'availability')
+
+    def __init__(self, Client=None, Server=None, Dependency=None, Engine=None, seed=None, antithetic=False,
+                 **strategies):
+        self.Client = configuration(Client or globals()['Client'])
+        self.Server = configuration(Server or globals()['Server'])
+        self.Dependency = configuration(Dependency or globals()['Dependency'])
+        self.Engine = configuration(Engine or globals()['Engine'])
+        self.reseed(seed, antithetic)
+        self.replace(**strategies)
+        self.setup()
+
+    def replace(self, **strategies):
+        # Replaces strategies, here or on a simulation already running (one restored from a snapshot, say),
+        # after which they are timed like the rest if the engine is profiling
+        for name, fn in strategies.items():
+            if name not in Simulation.strategies:
+                raise TypeError("'%s' is not a strategy" % name)
+            setattr(self, name, fn)
+
+        # An abandon() replaced without a revisit() to go with it gets asked about all of q2 on every step
+        self.scan_abandon = self.replaced('abandon') and not self.replaced('revisit')
+
+        if self.Engine.profile:
+            for name in Simulation.strategies:
+                if not isinstance(getattr(self, name), _Timed):
+                    setattr(self, name, _Timed(self, name, getattr(self, name)))
+
+    def replaced(self, name):
+        # Whether strategy name is other than Simulation's own, passed in or overridden in a subclass
+        fn = getattr(self, name)
+        if isinstance(fn, _Timed):
+            fn = fn.fn
+        return getattr(fn, '__func__', None) is not getattr(Simulation, name)
+
+    def reseed(self, seed=None, antithetic=False):
+        # Each source of randomness in random_sources draws from self.random_<source>, and other strategies
+        # from self.random. Given a seed, each source has a stream of its own, derived from the seed and the
+        # source's name, so that simulations with the same seed see the same arrivals, keys and dependency
+        # calls (call by call) whatever else differs between them: common random numbers, for comparing
+        # configurations with much less noise (see paired_difference()). With antithetic, every draw is the
+        # antithetic partner of the one the same seed would give (see Antithetic). Without a seed, everything
+        # draws from the module's random(), or from a single Variates seeded from it, so that random.seed()
+        # still applies.
+        numpy = self.Engine.variates == 'numpy'
+        if seed is None:
+            self.random = Variates(getrandbits(64)) if numpy else random
+            streams = {name: self.random for name in self.random_sources}
+        else:
+            self.random = Variates(seed) if numpy else Random(seed).random
+            streams = {}
+            for name in self.random_sources:
+                stream_seed = Random("%s/%s" % (seed, name)).getrandbits(64)
+                streams[name] = Variates(stream_seed) if numpy else Random(stream_seed).random
+
+        if antithetic:
+            self.random = Antithetic(self.random)
+            streams = {name: Antithetic(stream) for name, stream in streams.items()}
+
+        self.streams = seed is not None
+        for name, stream in streams.items():
+            setattr(self, 'random_' + name, stream)
+        self._draw()
+
+    def _draw(self):
+        # The default strategies draw through self.draw_<source>: the source itself if it is a Variates,
+        # or else Draws around it
+        for name in self.random_sources:
+            stream = getattr(self, 'random_' + name)
+            setattr(self, 'draw_' + name, stream if isinstance(stream, Variates) else Draws(stream))
+
+    def setup(self):
+        self.clock = Clock()
+        self.cache = caches[self.Server.cache_policy](self.clock, self.Server.cache_size, self.Server.ttl)
+        self.admission = admissions[self.Server.admission](self.Server)
+        self.arrivals = arrival_processes[self.Client.arrivals](self)
+        self.clear()
+        self.p1 = []
+        self.p2 = []
+        self.q1 = disciplines[self.Server.q1_discipline]('q1', self)
+        self.q2 = disciplines[self.Server.q2_discipline]('q2', self)
+        self.health = DependencyHealth()
+        self.events = []
+        self.abandon_due = []  # heap of (ts, n, queue_seq, r): when to next ask abandon() about r
+        self.abandon_n = 0
+        self.next_arrival_ts = 0
+        self.changes = 0
+        self.intervals = {}  # metric -> (mean, 95% half-width, batches), see run_until_precise()
+
+    #
+    # Snapshots
+    #
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['random'] + ['random_' + name for name in self.random_sources]:
+            if state[name] is random:
+                state[name] = None  # the module's source, whose state is saved by snapshot()
+        for name in self.random_sources:
+            del state['draw_' + name]  # made again from the sources
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in ['random'] + ['random_' + name for name in self.random_sources]:
+            if getattr(self, name) is None:
+                setattr(self, name, random)
+        self._draw()
+
+    def snapshot(self):
+        # Everything needed to carry on from this point (clock, queues, pools and in-flight workers, cache,
+        # schedule, settings, strategies and random state) as bytes. Strategies are saved by reference, so
+        # any state they keep outside the simulation is not included.
+        shared = self.random is random
+        return pickle.dumps((self, getstate() if shared else None))
+
+    @staticmethod
+    def restore(data):
+        sim, state = pickle.loads(data)
+        if state is not None:
+            setstate(state)
+        return sim
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.snapshot())
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return Simulation.restore(f.read())
+
+    def cache_hit(self, r):
+        if r.cache_ts:
+            return self.cache_age(r) < self.Server.ttl
+
+    def cache_age(self, r):
+        if r.responded:
+            return r.end_ts - r.cache_ts
+
+        return self.clock.ts - r.cache_ts
+
+    #
+    # Overridable functions
+    #
+
+    def configure(self):
+        pass
+
+    def abandon(self, r):
+        # if r.tries >= 1 and cache_hit(r):
+        #   return 'reneg'
+
+        if self.cache_hit(r) or r.tries >= self.Server.tries:
+            return "reneg"
+
+        return 'wait'
+
+    def revisit(self, r):
+        # The tick from which abandon() should next be asked about r, still waiting in q2 after its answer, or
+        # None if the answer can only change with r's own state (abandon() is asked about every request as it
+        # is enqueued). A rule that renegs once a request has been waiting for a latency budget would return
+        # r.start_ts + budget; one that renegs on a cache entry until it ages past some limit, nothing before
+        # the entry is read and r.cache_ts + limit after. Rules that depend on state beyond the request should
+        # call revisit_all() when it changes. The default abandon() looks at the cache entry read for r and
+        # at its tries, and once it has said 'wait', neither changes while r waits.
+        return None
+
+    def response(self, r):
+        return "cached" if self.cache_hit(r) else "fallback"
+
+    def qos(self, r):
+        Client = self.Client
+        if r.response_type == 'rejected':
+            value = Client.rejected
+        elif r.response_type == 'live':
+            value = Client.live
+        elif r.response_type == 'fallback':
+            value = Client.fallback
+        else:
+            value = sigmoid(self.cache_age(r), Client.cache_age_max, Client.cache_age_k)
+
+        return value * sigmoid(r.latency(), Client.decay_max, Client.decay_k)
+
+    def sample(self):
+        return int(self.draw_keys.exponential(self.Client.key_space))
+
+    def dependency(self):
+        Dependency = self.Dependency
+        t = self.draw_latency.std_normal() * Dependency.std + Dependency.mean
+        if t > Dependency.timeout and not self.streams:
+            return Dependency.timeout, 'timeout'
+
+        # With streams of their own the coin is tossed for timeouts too, so that paired runs with different
+        # timeouts stay in step call by call
+        available = self.draw_availability.uniform() < Dependency.availability
+        if t > Dependency.timeout:
+            return Dependency.timeout, 'timeout'
+
+        return t, 'success' if available else 'failure'
+
+    def replay(self, r):
+        # The recorded first call of a request from a trace, cut off at Dependency.timeout like any other
+        t, result = r.recorded
+        r.recorded = None
+        if t > self.Dependency.timeout:
+            return self.Dependency.timeout, 'timeout'
+        return t, result
+
+    def priority(self, r):
+        # Used by the 'priority' queue discipline; higher values are dequeued first
+        return 1
+
+    #
+    # Report
+    #
+
+    def stats(self, reqs=None):
+        # Of the given requests or, by default, of all those responded to since warmup
+        if reqs:
+            s = {
+                'count': len(reqs),
+                'qos': _avg_qos(reqs, self.qos),
+                'tries': _avg_tries(reqs),
+                'latency': _avg_latency(reqs),
+                'q1': _avg_queue_t(reqs, 'q1'),
+                'q2': _avg_queue_t(reqs, 'q2'),
+                'dependency': _avg_dep_t(reqs)}
+
+            latency = Histogram()
+            for r in reqs:
+                latency.add(r.latency())
+            s.update(('latency_p%d' % p, latency.quantile(p/100)) for p in Totals.percentiles)
+            return s
+
+        s = self.totals.stats()
+        ticks = self.clock.ts - self.start_ts
+        s['throughput'] = 1000 * self.totals.stats(['live'])['count']/ticks if ticks else 0  # per 1000 ticks
+        s['limit'] = self.admission.limit
+        s['hit_rate'] = self.totals.hits/self.totals.served if self.totals.served else 0
+        s['evicted'] = self.cache.evicted
+        s['cache_bytes'] = self.cache.footprint()
+        for m, (mean, h, n) in self.intervals.items():
+            s[m + '_ci'] = h
+
+        return s
+
+    def report(self):
+        totals = self.totals
+        _stats_header()
+        _stats_row('all', totals.stats())
+
+        for t in ['rejected', 'cached', 'live', 'fallback']:
+            _stats_row(t, totals.stats([t]))
+
+        print()
+        _percentiles_header()
+        _percentiles_row('all', totals.combined_histograms())
+
+        for t in ['rejected', 'cached', 'live', 'fallback']:
+            _percentiles_row(t, totals.combined_histograms([t]))
+
+        print()
+
+        if self.Server.ttl > 0:
+            print("cache hits %d/%d = %.2f" %
+                  (totals.hits, totals.served, totals.hits/totals.served))
+            print("   entries %d/%d = %.2f" %
+                  (totals.entries, totals.served, totals.entries/totals.served))
+            print("     cache %s: %d entries, %d evicted, %d expired, %.0f KB" %
+                  (self.Server.cache_policy, len(self.cache.entries), self.cache.evicted,
+                   self.cache.expired, self.cache.footprint()/1024))
+
+        if self.Server.admission != 'none':
+            admission = self.admission
+            print(" admission %s: limit %.1f, %d in flight (%d cheap), %d rejected" %
+                  (self.Server.admission, admission.limit, admission.normal + admission.cheap, admission.cheap,
+                   admission.rejected))
+
+        if self.intervals:
+            print()
+            for m, (mean, h, n) in self.intervals.items():
+                print("%10s %.4f +/- %.4f (95%%, %d batches)" % (m, mean, h, n))
+
+        if self.profile:
+            print()
+            self.profile.report()
+
+    #
+    # Main loop
+    #
+
+    def schedule(self, ts, kind):
+        # Only the event engine consumes the schedule; the tick loop looks at everything every tick anyway
+        if self.Engine.mode == 'event':
+            heapq.heappush(self.events, (ts, kind))
+
+    def enqueue_or_respond(self, q2, r):
+        if q2.full(self.Server.q2_max):
+            self.respond(r)  # essentially the eviction case
+            # print("%d %s" % (clock.ts, r.response_type))
+
+        else:
+            q2.enqueue(r)
+            if q2 is self.q2:
+                self.abandon_at(r, self.clock.ts)
+
+    def abandon_at(self, r, ts):
+        # Has abandon() asked about r, in q2, on the first step at or after ts
+        if ts is None or ts == math.inf:
+            return
+
+        ts = math.ceil(ts)
+        self.abandon_n += 1
+        heapq.heappush(self.abandon_due, (ts, self.abandon_n, r.queue_seq, r))
+        if ts > self.clock.ts:
+            self.schedule(ts, 'revisit')
+
+    def revisit_all(self):
+        # Has abandon() asked about all of q2 again, for rules whose answers depend on state that has changed
+        for r in self.q2.items:
+            self.abandon_at(r, self.clock.ts)
+
+    def respond(self, r, response_type=None):
+        if not r.responded:
+            self.changes += 1
+            r.response_type = response_type if response_type else self.response(r)
+            r.end_ts = self.clock.ts
+            r.responded = True
+            if r.path:
+                self.admission.release(r)
+            qos = self.qos(r)
+            if self.export:  # first, so that a response it refuses is not counted either
+                self.export.add(r, qos, self.cache_age(r) if r.cache_ts else math.nan)
+            self.totals.add(r, qos, self.cache_hit(r))
+            if self.Engine.keep_requests:
+                self.completed.append(r)
+
+    def step(self):
+        self.configure()
+        self.complete_p2()
+        self.dispatch_p1()
+        self.abandon_q2()
+        self.dispatch_p2()
+        self.arrive()
+
+    def profiled_step(self):
+        # step(), timing each phase into self.profile
+        profile = self.profile
+        profile.events += 1
+        self.configure()
+        for name in profile.phases:
+            start = perf_counter()
+            items = getattr(self, name)()
+            timing = profile.steps[name]
+            timing[0] += 1
+            timing[1] += perf_counter() - start
+            timing[2] += items
+
+    # The phases of a step, each returning the number of items it handled
+
+    def complete_p2(self):
         # Process existing p2 work (ie, check on workers waiting on dependency)
-        #
-        p2_complete = complete(p2)
-        p2 = not_complete(p2)
+        p2_complete = complete(self.p2)
+        self.p2 = not_complete(self.p2)
         for w in p2_complete:
             w.r.tries += 1
+            self.health.record(self.clock.ts, w.t, w.result)
 
             if w.result == 'success':
-                cache.write(w.r.key)
-                respond(w.r, 'live')
+                self.cache.write(w.r.key)
+                self.respond(w.r, 'live')
 
             else:  # for possible retry
-                enqueue_or_respond(q2, w.r)
+                self.enqueue_or_respond(self.q2, w.r)
 
-        # Process p1 work: read from q1, read from cache and write to q2
-        #
-        p1 = not_complete(p1)
-        while (not q1.empty()) and (len(p1) < Server.p1_max):
-            worker = P1Worker(q1.dequeue())
-            p1.append(worker)
+        return len(p2_complete)
 
-        # Make abandonment decisions
-        #
-        for r in q2.items:
-            decision = abandon(r)
+    def dispatch_p1(self):
+        # Process p1 work: read from q1, read from cache and write to q2
+        q1 = self.q1
+        self.p1 = not_complete(self.p1)
+        n = 0
+        while (not q1.empty()) and (len(self.p1) < self.Server.p1_max):
+            worker = P1Worker(self, q1.dequeue())
+            self.p1.append(worker)
+            n += 1
+
+        return n
+
+    def abandon_q2(self):
+        # Make abandonment decisions, about the requests due (see revisit()) or, failing a revisit() to go
+        # with abandon(), all of q2
+        q2 = self.q2
+        scan = self.scan_abandon
+        items = q2.items if scan else self.due()
+        for r in items:
+            decision = self.abandon(r)
             if decision == 'reneg':
                 q2.remove(r)
-                respond(r)
+                self.respond(r)
 
             elif decision == 'split':
-                respond(r)
+                self.respond(r)
 
-        # Process "new" p2 work (ie, handle some requests waiting in p2)
-        #
-        while (not q2.empty()) and (len(p2) < Server.p2_max):
-            worker = P2Worker(q2.dequeue())
-            p2.append(worker)
+            if not scan and r.queue is q2:
+                ts = self.revisit(r)
+                self.abandon_at(r, ts if ts is None else max(ts, self.clock.ts + 1))
 
-        # Process new request, if any
-        #
-        if clock.ts % Client.rate == 0:
-            r = Request(sample())
-            created.append(r)
-            if q1.full(Server.q1_max):
-                respond(r, 'rejected')
+        return len(items)
+
+    def due(self):
+        # The requests in q2 due to be asked about, in queue order; entries for requests that have since left
+        # q2 (or been enqueued again) are dropped as they come up
+        ts, heap, q2 = self.clock.ts, self.abandon_due, self.q2
+        due = {}
+        while heap and heap[0][0] <= ts:
+            entry = heapq.heappop(heap)
+            r = entry[3]
+            if r.queue is q2 and r.queue_seq == entry[2]:
+                due[id(r)] = r
+
+        return q2.in_order(due.values()) if len(due) > 1 else list(due.values())
+
+    def dispatch_p2(self):
+        # Process "new" p2 work (ie, handle some requests waiting in p2)
+        q2 = self.q2
+        n = 0
+        while (not q2.empty()) and (len(self.p2) < self.Server.p2_max):
+            worker = P2Worker(self, q2.dequeue())
+            self.p2.append(worker)
+            n += 1
+
+        return n
+
+    def arrive(self):
+        # Process new requests, if any
+        q1 = self.q1
+        n = 0
+        for r in self.arrivals.arrivals(self.clock.ts):
+            if self.Engine.keep_requests:
+                self.created.append(r)
+            if q1.full(self.Server.q1_max) or not self.admission.admit(r):
+                self.respond(r, 'rejected')
 
             else:
                 q1.enqueue(r)
+            n += 1
+
+        return n
+
+    def main(self, ticks):
+        profile = self.profile
+        if profile:
+            start_ts, start = self.clock.ts, perf_counter()
+
+        if self.Engine.mode == 'event':
+            self.main_events(ticks)
+        else:
+            self.main_ticks(ticks)
+
+        if profile:
+            profile.ticks += self.clock.ts - start_ts
+            profile.seconds += perf_counter() - start
+        if self.export:
+            self.export.flush()
+
+    def main_ticks(self, ticks):
+        step = self.profiled_step if self.profile else self.step
+        while self.clock.ts < ticks:
+            self.clock.tick()
+            step()
+
+    def main_events(self, ticks):
+        clock, events = self.clock, self.events
+        step = self.profiled_step if self.profile else self.step
+
+        # Re-seed the schedule in case the previous run used the tick loop; duplicates are skipped below
+        self.schedule(clock.ts + 1, 'check')
+        for w in self.p2:
+            self.schedule(w.done_tick(), 'completion')
+        self.next_arrival_ts = self.arrivals.next_ts(clock.ts)
+        if self.next_arrival_ts is not None:
+            self.schedule(self.next_arrival_ts, 'arrival')
+
+        while events and events[0][0] <= ticks:
+            ts, kind = heapq.heappop(events)
+            if ts <= clock.ts:
+                continue
+
+            clock.advance(ts)
+            before = self.changes
+            step()
+
+            # A tick that changed nothing leaves the next one with nothing to do either (until the next
+            # arrival or completion), so only state changes need the following tick checked
+            if self.changes != before:
+                self.schedule(ts + 1, 'check')
+
+            arrival_ts = self.arrivals.next_ts(ts)
+            if arrival_ts != self.next_arrival_ts:
+                self.next_arrival_ts = arrival_ts
+                if arrival_ts is not None:
+                    self.schedule(arrival_ts, 'arrival')
+
+        if clock.ts < ticks:
+            clock.advance(ticks)
+
+    def clear(self):
+        # Forgets the requests responded to so far, as at the end of warmup
+        self.created = []
+        self.completed = []
+        self.totals = Totals()
+        self.cache.evicted = self.cache.expired = 0
+        self.admission.rejected = 0
+        self.start_ts = self.clock.ts
+        self.profile = Profile() if self.Engine.profile else None
+        # Exports start afresh too, so that they cover the same responses as stats()
+        Engine = self.Engine
+        self.export = RequestExport(Engine.export, Engine.export_chunk) if Engine.export else None
+
+    def warmup(self, ticks=500000):
+        self.main(self.clock.ts + ticks)
+        self.clear()
+
+    def run_experiment(self, ticks):
+        self.main(self.clock.ts + ticks)
+        self.report()
+
+    #
+    # Steady state
+    #
+
+    steady_metrics = ('qos', 'latency', 'q1', 'q2')
+
+    def _run_batch(self, ticks):
+        # Stats of the requests completed during the next ticks, if any
+        before = self.totals - Totals()
+        self.main(self.clock.ts + ticks)
+        batch = (self.totals - before).stats()
+        return batch if batch['count'] else None
+
+    def run_batches(self, ticks, batch=10000):
+        # Stats of each batch of ticks over the next ticks (None for a batch with no responses), for
+        # paired_difference()
+        return [self._run_batch(batch) for _ in range(max(1, round(ticks / batch)))]
+
+    def warmup_until_steady(self, batch=10000, batches=5, tolerance=0.05, max_ticks=500000):
+        # Warms up in batches of ticks until the latest batches agree with the ones before them on each of
+        # steady_metrics (see _steady), or for max_ticks. Returns the ticks used.
+        start = self.clock.ts
+        history = []
+        while self.clock.ts - start < max_ticks:
+            s = self._run_batch(batch)
+            if s:
+                history.append(s)
+            if len(history) >= 2 * batches and _steady(history[-2 * batches:], self.steady_metrics, tolerance):
+                break
+
+        self.clear()
+        return self.clock.ts - start
+
+    def run_until_precise(self, precision=0.02, batch=10000, min_batches=10, max_ticks=500000,
+                          metrics=('qos',)):
+        # Measures in batches of ticks until the 95% confidence half-width of each metric, from the batch
+        # means, is within precision (relative) of its mean, or for max_ticks. The intervals are kept in
+        # self.intervals, and so appear in stats() and report().
+        #
+        # A run costs at least min_batches batches. With the defaults, the default configuration at rates
+        # from 50 to 20 stops after those 100,000 ticks or a few batches more, against 500,000 for a fixed
+        # run_experiment(). Latency is far noisier relative to its mean, being mostly hits of next to nothing
+        # and misses of well over 100 ticks: its half-width is still about 3% after 1,000,000 ticks at rate
+        # 25, so with it among the metrics, precision needs to be about 0.05 and max_ticks well over 500,000
+        # for the run to stop early.
+        start = self.clock.ts
+        batches = []
+        while self.clock.ts - start < max_ticks:
+            s = self._run_batch(batch)
+            if s:
+                batches.append(s)
+
+            self.intervals = {m: _interval([b[m] for b in batches]) + (len(batches),) for m in metrics}
+            if len(batches) >= min_batches and \
+                    all(h <= precision * abs(mean) for mean, h, n in self.intervals.values()):
+                break
+
+        return self.intervals
+
+
+def mean_batches(*runs):
+    # Batch by batch means of the stats of runs over the same ticks, such as a run and its antithetic twin
+    batches = []
+    for group in zip(*runs):
+        if None in group:
+            batches.append(None)
+        else:
+            batches.append({m: _avg([b[m] for b in group]) for m in group[0]})
+    return batches
+
+
+def paired_difference(a, b, metrics=('qos', 'latency')):
+    # Mean and 95% confidence half-width of the difference b - a in each metric, with the number of batches,
+    # from the run_batches() of two simulations over the same ticks. With the same seed the two see the same
+    # arrivals and dependency calls, so most of the noise cancels batch by batch and the interval is much
+    # tighter than the two runs' own.
+    pairs = [(x, y) for x, y in zip(a, b) if x is not None and y is not None]
+    return {m: _interval([y[m] - x[m] for x, y in pairs]) + (len(pairs),) for m in metrics}
+
+#
+# The default simulation, driven through module-level functions and settings. Scripts configure it by
+# changing Client, Server, Dependency and Engine and by replacing the functions below; setup() then builds
+# a fresh Simulation from whatever is in place at the time, which goes on reading those settings as it runs.
+#
 
 
-def setup():
-    global clock, created, completed, cache, p1, p2, q1, q2
-    p1 = []
-    p2 = []
-    created = []
-    completed = []
-    cache = Cache()
-    q1 = Queue('q1')
-    q2 = Queue('q2')
-    cache = Cache()
-    clock = Clock()
+_sim = None
+_shared = ('clock', 'created', 'completed', 'totals', 'cache', 'health', 'admission', 'profile',
+           'p1', 'p2', 'q1', 'q2', 'random_arrivals', 'random_keys', 'random_latency', 'random_availability')
+
+
+def __getattr__(name):
+    # qm.clock, qm.completed, etc. are the default simulation's
+    if name in _shared and _sim is not None:
+        return getattr(_sim, name)
+
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+#
+# Overridable functions
+#
+
+
+def configure():
+    return Simulation.configure(_sim)
+
+
+def abandon(r):
+    return Simulation.abandon(_sim, r)
+
+
+def revisit(r):
+    return Simulation.revisit(_sim, r)
+
+
+def response(r):
+    return Simulation.response(_sim, r)
+
+
+def qos(r):
+    return Simulation.qos(_sim, r)
+
+
+def sample():
+    return Simulation.sample(_sim)
+
+
+def dependency():
+    return Simulation.dependency(_sim)
+
+
+def priority(r):
+    return Simulation.priority(_sim, r)
+
+
+_defaults = {name: globals()[name] for name in Simulation.strategies}
+
+
+def cache_hit(r):
+    return _sim.cache_hit(r)
+
+
+def cache_age(r):
+    return _sim.cache_age(r)
+
+#
+# Report
+#
+
+
+def stats(reqs=None):
+    return _sim.stats(reqs)
+
+
+def report():
+    _sim.report()
+
+#
+# Main loop
+#
+
+
+def enqueue_or_respond(q2, r):
+    _sim.enqueue_or_respond(q2, r)
+
+
+def respond(r, response_type=None):
+    _sim.respond(r, response_type)
+
+
+def step():
+    _sim.step()
+
+
+def main(ticks):
+    _sim.main(ticks)
+
+
+def replaced_strategies():
+    # The module-level strategy functions that a script has replaced
+    return {name: globals()[name] for name in Simulation.strategies
+            if globals()[name] is not _defaults[name]}
+
+
+def setup(seed=None, antithetic=False):
+    global _sim
+    _sim = Simulation(seed=seed, antithetic=antithetic, **replaced_strategies())
+    # It runs on the module's settings themselves rather than copies, so that a configure() that changes,
+    # say, Client.rate changes it for the run in progress
+    _sim.Client, _sim.Server, _sim.Dependency, _sim.Engine = Client, Server, Dependency, Engine
 
 
 def warmup(ticks=500000):
-    global created, completed
     setup()
-    main(ticks)
-    created = []
-    completed = []
+    _sim.warmup(ticks)
 
 
 def run_experiment(ticks):
-    main(clock.ts + ticks)
+    _sim.run_experiment(ticks)
+
+
+def run_batches(ticks, batch=10000):
+    return _sim.run_batches(ticks, batch)
+
+
+def warmup_until_steady(**kwargs):
+    setup()
+    return _sim.warmup_until_steady(**kwargs)
+
+
+def run_until_precise(**kwargs):
+    _sim.run_until_precise(**kwargs)
     report()
 
 
+def snapshot():
+    return _sim.snapshot()
+
+
+def restore(data):
+    global _sim
+    _sim = Simulation.restore(data)
+
+
 if __name__ == '__main__':
     warmup()
     run_experiment(500000)
@@ -0,0 +1,81 @@
+import quartermaster as qm
+import stage as st
+
+# timeout.py asks when giving up on a slow call and trying again improves QoS. Here the same question is put to the retry, hedging and circuit-breaker stages in stage.py, which all sit in front of the same dependency, so they can be compared side by side on QoS, latency and throughput.
+
+# SETUP
+
+# The dependency is timeout.py's: a normal case with mean 100 and a slow case, a quarter of the time, that always fails (situation (3) in timeout.py). The server is a single stage with timeout.py's p2_max and q2_max, and the client is timeout.py's too.
+
+normal_mean = 100
+slow_mean = 200
+std = 25
+
+
+class Bimodal(st.Stage):
+    def call(self, r):
+        random = self.pipeline.random
+        if qm.coin_toss(0.75, random):
+            return qm.normal(normal_mean, std, random), 'success' if qm.coin_toss(0.98, random) else 'failure'
+
+        return qm.normal(slow_mean, std, random), 'failure'
+
+
+class Retry(st.RetryStage, Bimodal):
+    pass
+
+
+class Hedged(st.HedgedStage, Bimodal):
+    pass
+
+
+class HedgedRetry(st.RetryStage, st.HedgedStage, Bimodal):
+    pass
+
+
+class Breaker(st.RetryStage, st.CircuitBreakerStage, Bimodal):
+    pass
+
+
+qm.Client.decay_k = 4
+qm.Client.rate = 50
+qm.Client.decay_max = 500
+
+# The techniques, as a stage each. The aggressive timeout is timeout.py's, normal_mean + 2*std. Backoffs are short next to decay_max, since a retry that waits long is worth little to the client anyway.
+
+
+def techniques():
+    aggressive = normal_mean + 2*std
+    server = {'workers': 5, 'queue_size': 12}
+    return [
+        ('wait', Bimodal('dep', timeout=qm.Client.decay_max, **server)),
+        ('timeout', Bimodal('dep', timeout=aggressive, **server)),
+        ('retry', Retry('dep', timeout=aggressive, backoff=0, jitter=None, **server)),
+        ('backoff', Retry('dep', timeout=aggressive, backoff=10, **server)),
+        ('hedge', Hedged('dep', timeout=qm.Client.decay_max, hedge_after=aggressive, **server)),
+        ('hedge+retry', HedgedRetry('dep', timeout=aggressive, hedge_after=normal_mean, **server)),
+        ('breaker', Breaker('dep', timeout=aggressive, threshold=0.5, window=20, open_for=1000, **server))]
+
+
+# SIMULATIONS RUN
+
+print("slow_mean,technique,qos,latency,latency_p99,throughput,success,fail,evicted")
+for slow_mean in [150, 200, 300, 400, 500]:
+    for name, stage in techniques():
+        pipeline = st.Pipeline(stage, keep_requests=False)
+        pipeline.warmup(100000)
+        pipeline.main(pipeline.clock.ts + 200000)
+        s = pipeline.stats()
+        print("%d,%s,%.2f,%.1f,%.1f,%.2f,%d,%d,%d" %
+              (slow_mean, name, s['qos'], s['latency'], s['latency_p99'], s['throughput'],
+               s.get('success', 0), s.get('fail', 0), s.get('evicted', 0)))
+
+# INSIGHTS
+
+# - Because the slow case always fails, waiting it out buys nothing. The aggressive timeout caps latency at 150 whatever the slow mean, for the price of the few normal calls that run past it, and so it beats waiting once the slow case is slow enough (here from a slow mean of about 400).
+
+# - Retrying is what turns those timeouts into successes: nearly every request succeeds, throughput goes from about 14.5 to 19.5 per 1000 ticks and QoS from about 0.75 to 0.82. At this arrival rate the extra calls fit comfortably, so backoff and jitter make no difference; they matter once retries compete with new requests for workers.
+
+# - Hedging on its own helps only while the slow case is close to the normal one. Hedges need a free worker, and the slow calls tie workers up for longer and longer. Hedging after normal_mean with retries on top is best at every slow mean (QoS about 0.87).
+
+# - The slow case here is independent from call to call, so the breaker only opens on chance runs of failures, and each time it fails requests it could have retried; it does a little worse than the plain retry. It earns its keep when failures are correlated, as in an outage.
@@ -0,0 +1,559 @@
+import heapq
+import math
+from collections import deque
+from random import Random
+
+import quartermaster as qm
+
+# Pipelines of stages, after the design in stage.txt. Each stage has its own queue, pool of workers and
+# dependency, and hands the requests it completes to the next stage, or to one of several next stages so
+# that pipelines can branch into trees. Statistics are kept per stage and, on each request, per stage it
+# went through.
+#
+# Stages are driven by events rather than polled: a stage is processed on a tick only when a request was
+# added to it or one of its workers finished, so a run costs time in proportion to the requests and calls
+# made, however many stages the pipeline has and however many of them are idle.
+
+
+class StageStats:
+    # A request's time in one stage
+    __slots__ = ('stage', 'enter_ts', 'queue_t', 'work_t', 'result')
+
+    def __init__(self, stage, enter_ts):
+        self.stage = stage
+        self.enter_ts = enter_ts
+        self.queue_t = 0
+        self.work_t = 0
+        self.result = None  # 'success', 'failure', 'timeout', 'evicted' or 'open' (see CircuitBreakerStage)
+
+
+class PipelineRequest(qm.Request):
+    __slots__ = ('stages',)
+
+    def __init__(self, key, start_ts):
+        super().__init__(key, start_ts)
+        self.stages = []  # a StageStats per stage entered, in order
+
+
+class Stage:
+    # The default stage holds up to queue_size requests in a queue of one of qm.disciplines and serves them
+    # with up to `workers` calls at a time to its dependency, a configuration like qm.Dependency (without one,
+    # the work takes no time beyond the tick). Calls that take longer than timeout, if given, are given up on
+    # at timeout. next_stage is a stage, a list of them or None for the last.
+    #
+    # Other behaviour comes from overriding add() (admission), call() (the work), success(), fail() and
+    # evict() (what happens next), priority() (for the 'priority' discipline) and route() (which of several
+    # next stages a request goes to; the least loaded by default). The subclasses below do so for retries,
+    # hedging and circuit breaking, and combine by multiple inheritance, e.g.
+    # class Resilient(RetryStage, CircuitBreakerStage).
+
+    def __init__(self, name, workers=5, queue_size=10, discipline='fifo', dependency=None, next_stage=None,
+                 timeout=None):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.discipline = discipline
+        self.Dependency = None if dependency is None else qm.configuration(dependency)
+        self.timeout = timeout
+        if next_stage is None:
+            self.next_stages = []
+        elif isinstance(next_stage, Stage):
+            self.next_stages = [next_stage]
+        else:
+            self.next_stages = list(next_stage)
+        self.pipeline = None
+
+    def attach(self, pipeline):
+        # Called by the pipeline the stage is part of. The stage serves as its queue's simulation.
+        self.pipeline = pipeline
+        self.clock = pipeline.clock
+        self.changes = 0
+        self.queue = qm.disciplines[self.discipline](self.name, self)
+        self.queue.wait_slot = None  # waits are kept in StageStats instead
+        self.busy = 0
+        self.active = False  # waiting in the pipeline to be processed
+        self.clear()
+
+    def clear(self):
+        self.traffic = {'added': 0, 'evicted': 0, 'success': 0, 'fail': 0}
+        self.queue_t = qm.Tally()
+        self.work_t = qm.Tally()
+        self.work_histogram = qm.Histogram()
+
+    def load(self):
+        return len(self.queue) + self.busy
+
+    #
+    # The interface between stages
+    #
+
+    def add(self, r):
+        self.traffic['added'] += 1
+        r.stages.append(StageStats(self.name, self.clock.ts))
+
+        if self.queue.full(self.queue_size):
+            self.evict(r)
+        else:
+            self.queue.enqueue(r)
+            self.pipeline.activate(self)
+
+    def process(self):
+        # Starts work on queued requests while there are free workers
+        while not self.queue.empty() and self.busy < self.workers:
+            r = self.queue.dequeue()
+            stats = r.stages[-1]
+            stats.queue_t = self.clock.ts - r.enqueue_ts
+            self.queue_t.add(stats.queue_t)
+            self.start(r)
+
+    def start(self, r):
+        t, result = self.attempt(r)
+        self.busy += 1
+        self.pipeline.schedule(self.done_tick(t), self.complete, r, t, result)
+
+    def attempt(self, r):
+        # call(), given up on at the stage's timeout
+        t, result = self.call(r)
+        if self.timeout is not None and t > self.timeout:
+            return self.timeout, 'timeout'
+        return t, result
+
+    def done_tick(self, t):
+        # A call made now is done on the first tick at or after it returns, but no earlier than the next
+        # tick, as with qm.P2Worker
+        return max(self.clock.ts + 1, math.ceil(self.clock.ts + t))
+
+    def complete(self, r, t, result):
+        self.busy -= 1
+        self.pipeline.activate(self)
+
+        stats = r.stages[-1]
+        stats.work_t = t
+        stats.result = result
+        r.tries += 1
+        r.dependency_t += t
+        self.work_t.add(t)
+        self.work_histogram.add(t)
+
+        if result == 'success':
+            self.traffic['success'] += 1
+            self.success(r)
+        else:
+            self.traffic['fail'] += 1
+            self.fail(r)
+
+    #
+    # Overridable functions
+    #
+
+    def call(self, r):
+        # (time taken, 'success', 'failure' or 'timeout'), drawn as in Simulation.dependency()
+        Dependency = self.Dependency
+        if Dependency is None:
+            return 0, 'success'
+
+        random = self.pipeline.random
+        t = qm.normal(Dependency.mean, Dependency.std, random)
+        if t > Dependency.timeout:
+            return Dependency.timeout, 'timeout'
+
+        return t, 'success' if qm.coin_toss(Dependency.availability, random) else 'failure'
+
+    def priority(self, r):
+        return 1
+
+    def route(self, r):
+        if not self.next_stages:
+            return None
+        if len(self.next_stages) == 1:
+            return self.next_stages[0]
+
+        return min(self.next_stages, key=Stage.load)
+
+    def success(self, r):
+        next_stage = self.route(r)
+        if next_stage:
+            next_stage.add(r)
+        else:
+            self.respond(r, 'success')
+
+    def fail(self, r):
+        self.respond(r, 'fail')
+
+    def evict(self, r):
+        self.traffic['evicted'] += 1
+        r.stages[-1].result = 'evicted'
+        self.respond(r, 'evicted')
+
+    def respond(self, r, response_type):
+        # It is possible to respond and carry on, say by adding the request to another stage as well
+        self.pipeline.respond(r, response_type)
+
+
+class RetryStage(Stage):
+    # Retries failed calls, up to `attempts` in all, after backing off for backoff * multiplier**(n - 1)
+    # ticks (at most max_backoff) before the n-th retry, less jitter: 'full' waits a uniform part of that,
+    # 'equal' half of it plus a uniform part of the other half, and None all of it. Retries are scheduled for
+    # when they are due rather than checked on every tick, and wait outside the queue meanwhile, so a retry
+    # can find the queue full and be evicted.
+
+    def __init__(self, name, attempts=3, backoff=10, multiplier=2, max_backoff=1000, jitter='full', **kwargs):
+        super().__init__(name, **kwargs)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def clear(self):
+        super().clear()
+        self.traffic['retried'] = 0
+
+    def attempts_made(self, r):
+        # Retries go straight back into the stage, so its attempts are the latest of r.stages
+        n = 0
+        for stats in reversed(r.stages):
+            if stats.stage != self.name:
+                break
+            n += 1
+        return n
+
+    def delay(self, n):
+        delay = min(self.max_backoff, self.backoff * self.multiplier ** (n - 1))
+        if self.jitter == 'full':
+            return delay * self.pipeline.random()
+        if self.jitter == 'equal':
+            return delay/2 * (1 + self.pipeline.random())
+        return delay
+
+    def fail(self, r):
+        n = self.attempts_made(r)
+        if n >= self.attempts:
+            super().fail(r)
+            return
+
+        self.traffic['retried'] += 1
+        self.pipeline.schedule(self.clock.ts + math.ceil(self.delay(n)), self.add, r)
+
+
+class HedgedStage(Stage):
+    # Makes a second call for a request whose first has not returned after hedge_after ticks, if a worker is
+    # free then, and goes with whichever succeeds first (or the last to fail). The other call is cancelled,
+    # freeing its worker, when the first succeeds.
+
+    def __init__(self, name, hedge_after=100, **kwargs):
+        super().__init__(name, **kwargs)
+        self.hedge_after = hedge_after
+
+    def attach(self, pipeline):
+        super().attach(pipeline)
+        self.calls = {}  # request -> [start ts, hedged, ids of its calls in flight]
+        self._call_id = 0
+
+    def clear(self):
+        super().clear()
+        self.traffic['hedged'] = 0
+
+    def start(self, r):
+        self.calls[r] = [self.clock.ts, False, []]
+        first = self._call(r)
+        self.pipeline.schedule(self.clock.ts + self.hedge_after, self.hedge, r, first)
+
+    def _call(self, r):
+        t, result = self.attempt(r)
+        self._call_id += 1
+        self.calls[r][2].append(self._call_id)
+        self.busy += 1
+        self.pipeline.schedule(self.done_tick(t), self.returned, r, self._call_id, result)
+        return self._call_id
+
+    def hedge(self, r, first):
+        calls = self.calls.get(r)
+        if calls is None or calls[1] or first not in calls[2] or self.busy >= self.workers:
+            return
+
+        calls[1] = True
+        self.traffic['hedged'] += 1
+        self._call(r)
+
+    def returned(self, r, call_id, result):
+        calls = self.calls.get(r)
+        if calls is None or call_id not in calls[2]:
+            return  # cancelled
+
+        calls[2].remove(call_id)
+        if result != 'success' and calls[2]:
+            # The other call may yet succeed
+            self.busy -= 1
+            self.pipeline.activate(self)
+            return
+
+        del self.calls[r]
+        self.busy -= len(calls[2])
+        self.complete(r, self.clock.ts - calls[0], result)
+
+
+class CircuitBreakerStage(Stage):
+    # Fails requests straight away, without calling the dependency, while the circuit is open. It opens when
+    # more than threshold of the last `window` calls failed. After open_for ticks it half-opens, letting
+    # requests through only while fewer than `probes` are in the stage, and once `probes` calls have
+    # returned it closes if no more than threshold of them failed and opens again if not. The state only
+    # changes as requests arrive and calls return, so it needs no timer.
+
+    def __init__(self, name, threshold=0.3, window=10, open_for=3000, probes=3, **kwargs):
+        super().__init__(name, **kwargs)
+        self.threshold = threshold
+        self.window = window
+        self.open_for = open_for
+        self.probes = probes
+
+    def attach(self, pipeline):
+        super().attach(pipeline)
+        self.close()
+
+    def clear(self):
+        super().clear()
+        self.traffic['open'] = 0  # requests failed without a call
+        self.traffic['opened'] = 0
+
+    def open(self):
+        self.state = 'open'
+        self.opened_ts = self.clock.ts
+        self.traffic['opened'] += 1
+
+    def close(self):
+        self.state = 'closed'
+        self.results = deque(maxlen=self.window)  # 1 for each failed call, 0 for each success
+        self.errors = 0
+
+    def half_open(self):
+        self.state = 'half-open'
+        self.results = deque()
+        self.errors = 0
+
+    def admit(self):
+        if self.state == 'open' and self.clock.ts - self.opened_ts >= self.open_for:
+            self.half_open()
+
+        if self.state == 'half-open':
+            return self.load() < self.probes
+        return self.state == 'closed'
+
+    def add(self, r):
+        if self.admit():
+            super().add(r)
+            return
+
+        self.traffic['added'] += 1
+        self.traffic['open'] += 1
+        r.stages.append(StageStats(self.name, self.clock.ts))
+        r.stages[-1].result = 'open'
+        self.fail(r)
+
+    def record(self, error):
+        if self.state == 'open':
+            return  # a call made before the circuit opened
+
+        if len(self.results) == self.results.maxlen:
+            self.errors -= self.results[0]
+        self.results.append(error)
+        self.errors += error
+
+        if self.state == 'closed':
+            if len(self.results) == self.window and self.errors > self.threshold * self.window:
+                self.open()
+
+        elif len(self.results) >= self.probes:
+            if self.errors > self.threshold * len(self.results):
+                self.open()
+            else:
+                self.close()
+
+    def complete(self, r, t, result):
+        self.record(result != 'success')
+        super().complete(r, t, result)
+
+
+class Pipeline:
+    # Runs requests from a client, configured like qm.Client, through the stages reachable from entry. The
+    # schedule holds arrivals, worker completions and whatever else stages schedule (retries, say) as
+    # functions to call; the stages these touch are processed once all of a tick's events are in, in the
+    # order they became active.
+
+    def __init__(self, entry, Client=None, seed=None, keep_requests=True):
+        self.Client = qm.configuration(Client or qm.Client)
+        self.random = qm.random if seed is None else Random(seed).random
+        self.keep_requests = keep_requests
+        self.clock = qm.Clock()
+        self.events = []
+        self._seq = 0  # events on the same tick happen in the order they were scheduled
+        self.active = deque()
+
+        self.entry = entry
+        self.stages = []  # every stage reachable from entry, breadth first
+        pending = deque([entry])
+        while pending:
+            stage = pending.popleft()
+            if stage.pipeline is self:
+                continue
+            if any(s.name == stage.name for s in self.stages):
+                raise ValueError("more than one stage is called '%s'" % stage.name)
+
+            stage.attach(self)
+            self.stages.append(stage)
+            pending.extend(stage.next_stages)
+
+        self.clear()
+        self.schedule(self.Client.rate, self.arrive)
+
+    def sample(self):
+        return int(qm.exponential(self.Client.key_space, random=self.random))
+
+    def qos(self, r):
+        # As Simulation.qos(), with a success valued as a live response, a failure as a fallback and an
+        # eviction as a rejection
+        Client = self.Client
+        if r.response_type == 'success':
+            value = Client.live
+        elif r.response_type == 'evicted':
+            value = Client.rejected
+        else:
+            value = Client.fallback
+
+        return value * qm.sigmoid(r.latency(), Client.decay_max, Client.decay_k)
+
+    def schedule(self, ts, fn, *args):
+        # fn(*args) at ts
+        self._seq += 1
+        heapq.heappush(self.events, (ts, self._seq, fn, args))
+
+    def activate(self, stage):
+        if not stage.active:
+            stage.active = True
+            self.active.append(stage)
+
+    def respond(self, r, response_type):
+        if r.responded:
+            return
+
+        r.response_type = response_type
+        r.end_ts = self.clock.ts
+        r.responded = True
+
+        response = self.responses.get(response_type)
+        if response is None:
+            response = self.responses[response_type] = (qm.Tally(), qm.Histogram(), qm.Tally())
+        response[0].add(r.latency())
+        response[1].add(r.latency())
+        response[2].add(self.qos(r))
+
+        if self.keep_requests:
+            self.completed.append(r)
+
+    def arrive(self):
+        r = PipelineRequest(self.sample(), self.clock.ts)
+        if self.keep_requests:
+            self.created.append(r)
+        self.entry.add(r)
+        self.schedule(self.clock.ts + self.Client.rate, self.arrive)
+
+    def main(self, ticks):
+        clock, events, active = self.clock, self.events, self.active
+
+        while events and events[0][0] <= ticks:
+            ts, seq, fn, args = heapq.heappop(events)
+            clock.advance(ts)
+            fn(*args)
+
+            if events and events[0][0] == ts:
+                continue
+
+            while active:
+                stage = active.popleft()
+                stage.active = False
+                stage.process()
+
+        if clock.ts < ticks:
+            clock.advance(ticks)
+
+    def clear(self):
+        self.created = []
+        self.completed = []
+        self.responses = {}  # response type -> (latency Tally, latency Histogram, qos Tally)
+        self.start_ts = self.clock.ts
+        for stage in self.stages:
+            stage.clear()
+
+    def warmup(self, ticks=500000):
+        self.main(self.clock.ts + ticks)
+        self.clear()
+
+    def run_experiment(self, ticks):
+        self.main(self.clock.ts + ticks)
+        self.report()
+
+    #
+    # Report
+    #
+
+    def stats(self):
+        # Over the requests responded to since warmup, with throughput in successes per 1000 ticks
+        tally, latency, qos = qm.Tally(), qm.Histogram(), qm.Tally()
+        for t, h, q in self.responses.values():
+            tally = tally + t
+            latency = latency + h
+            qos = qos + q
+
+        ticks = self.clock.ts - self.start_ts
+        successes = self.responses['success'][0].n if 'success' in self.responses else 0
+        s = {'count': tally.n, 'qos': qos.mean(), 'latency': tally.mean(),
+             'throughput': 1000 * successes/ticks if ticks else 0}
+        s.update(('latency_p%d' % p, latency.quantile(p/100)) for p in qm.Totals.percentiles)
+        for response_type, (t, h, q) in self.responses.items():
+            s[response_type] = t.n
+        return s
+
+    def stage_stats(self):
+        # {stage name: {metric: value}}
+        return {stage.name: dict(stage.traffic, queue=stage.queue_t.mean(), work=stage.work_t.mean(),
+                                 work_p99=stage.work_histogram.quantile(0.99))
+                for stage in self.stages}
+
+    def report(self):
+        print('-' * 57)
+        print("%9s %6s %6s %6s %6s %6s %6s" % ('type', 'count', 'qos', 'time', 'p50', 'p95', 'p99'))
+        print('-' * 57)
+        for response_type, (t, h, q) in sorted(self.responses.items()):
+            print("%9s %6d %6.2f %6.1f %6.1f %6.1f %6.1f" %
+                  (response_type, t.n, q.mean(), t.mean(), h.quantile(0.5), h.quantile(0.95),
+                   h.quantile(0.99)))
+
+        print()
+        print('-' * 57)
+        print("%9s %6s %6s %6s %6s %6s %6s %6s" %
+              ('stage', 'added', 'evict', 'ok', 'fail', 'queue', 'work', 'w p99'))
+        print('-' * 57)
+        for name, s in self.stage_stats().items():
+            print("%9s %6d %6d %6d %6d %6.1f %6.1f %6.1f" %
+                  (name[:9], s['added'], s['evicted'], s['success'], s['fail'], s['queue'], s['work'],
+                   s['work_p99']))
+
+
+if __name__ == '__main__':
+    # quartermaster's server as a pipeline (a cache read, then the dependency) with a pair of replicated
+    # services behind it, each a chain of ten stages
+
+    def chain(prefix, length):
+        stage = None
+        for i in reversed(range(length)):
+            stage = Stage('%s%d' % (prefix, i), workers=10, queue_size=20, dependency=qm.Dependency,
+                          next_stage=stage)
+        return stage
+
+    dependency = Stage('dep', qm.Server.p2_max, qm.Server.q2_max, dependency=qm.Dependency,
+                       next_stage=[chain('a', 10), chain('b', 10)])
+    cache = Stage('cache', qm.Server.p1_max, qm.Server.q1_max, next_stage=dependency)
+
+    pipeline = Pipeline(cache, keep_requests=False)
+    pipeline.warmup()
+    pipeline.run_experiment(500000)
@@ -0,0 +1,227 @@
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import product
+
+import analytic
+import quartermaster as qm
+
+# Runs a set of configurations ("points") in parallel, each in its own Simulation. A point is a dict whose
+# keys are either settings, written 'Client.rate', 'Server.p2_max', etc., or strategies, written
+# 'Simulation.dependency', etc. (see qm.Simulation.strategies). Settings not given in a point are taken
+# from the module-level classes and strategies from whatever the calling script has put in place, both as
+# they are when sweep() is called.
+#
+# Each point gets its own seed, derived from the sweep's seed and the point's position, so results do not
+# depend on the number of processes or on which process runs which point. With common, every point gets the
+# sweep's seed instead, so that all of them see the same arrivals and dependency calls (common random
+# numbers; see qm.Simulation.reseed) and differences between rows are mostly down to the settings.
+#
+# Strategies are sent to worker processes by pickling, so they must be module-level functions (or
+# functools.partial of one); lambdas and closures will not do. They can be written as for the module's
+# default simulation, reading qm.clock, qm.health, qm.cache_hit() and the like: while a point runs, its
+# Simulation is the default one.
+#
+# With hybrid, points that analytic.py can estimate, and whose load on the dependency is well away from
+# saturation (outside saturation_band), are estimated rather than simulated; the rest are simulated as
+# usual. Rows say which they are under 'estimated'.
+
+saturation_band = (0.7, 1.3)  # utilizations that are always simulated
+
+# Settings that the parts of a Simulation (queues, admission policy, arrival process, how it draws and runs)
+# take when it is built, and that points started from a snapshot therefore cannot change. The cache takes
+# its ttl and size when built too, but they are handed on to it.
+fixed_settings = {
+    'Client': ('arrivals', 'trace', 'trace_scale', 'mmpp'),
+    'Server': ('q1_discipline', 'q2_discipline', 'cache_policy', 'admission', 'admission_limit',
+               'admission_normal', 'admission_cheap_cost', 'admission_min', 'admission_max',
+               'admission_latency'),
+    'Engine': ('mode', 'variates', 'profile')}
+
+
+def grid(axes):
+    # Every combination of the given values, e.g. grid({'Client.rate': [50, 25], 'Server.p2_max': [4, 5]})
+    names = list(axes)
+    return [dict(zip(names, values)) for values in product(*(axes[n] for n in names))]
+
+
+def simulation_args(point, base=None):
+    # Simulation() arguments for a point, with the settings it does not give taken from base (a warmed-up
+    # Simulation) or, by default, from the module along with the script's strategies
+    sections = ('Client', 'Server', 'Dependency', 'Engine')
+    settings = {section: {} for section in sections}
+    args = qm.replaced_strategies() if base is None else {}
+
+    for name, value in point.items():
+        section, _, setting = name.partition('.')
+        if section in settings:
+            fixed = base is not None and _fixed(base, section, setting)
+            if fixed and value != getattr(getattr(base, section), setting):
+                raise ValueError("'%s' is fixed when a Simulation is built, so it cannot differ from the "
+                                 "snapshot's" % name)
+            settings[section][setting] = value
+
+        elif section == 'Simulation' and setting in qm.Simulation.strategies:
+            args[setting] = value
+
+        else:
+            raise KeyError("'%s' is neither a setting nor a strategy" % name)
+
+    # Only stats() are collected, so there is no need to keep the requests
+    settings['Engine'].setdefault('keep_requests', False)
+
+    for section in sections:
+        args[section] = qm.configuration(getattr(base or qm, section), **settings[section])
+
+    return args
+
+
+def _fixed(sim, section, setting):
+    # A TinyLFU cache also sizes its sketch when built
+    if section == 'Server' and setting == 'cache_size':
+        return sim.Server.cache_policy == 'tinylfu'
+    return setting in fixed_settings.get(section, ())
+
+
+def run_point(args, seed, warmup, ticks, start, precision):
+    # Strategies that draw from the module's random() are seeded too
+    random.seed(seed)
+
+    # and those that read the simulation through qm.clock, qm.health, etc. see this point's, for as long as
+    # it runs; run in-process, the caller's default simulation is put back afterwards
+    caller = qm._sim
+    try:
+        if start is None:
+            sim = qm._sim = qm.Simulation(seed=seed, **args)
+            if precision:
+                sim.warmup_until_steady(max_ticks=warmup)
+            else:
+                sim.warmup(warmup)
+
+        else:
+            sim = qm._sim = qm.Simulation.restore(start)
+            sim.reseed(seed)
+            for name, value in args.items():
+                if name not in qm.Simulation.strategies:
+                    setattr(sim, name, value)
+            sim.replace(**{name: value for name, value in args.items() if name in qm.Simulation.strategies})
+            sim.cache.ttl = sim.Server.ttl
+            sim.cache.capacity = sim.Server.cache_size
+            sim.clear()
+
+        if precision:
+            sim.run_until_precise(precision, max_ticks=ticks)
+        else:
+            sim.main(sim.clock.ts + ticks)
+        return sim.stats(), sim.totals
+
+    finally:
+        qm._sim = caller
+
+
+def estimate_point(args, ticks):
+    # analytic.estimate() for a point's Simulation() arguments, or None if the point is not one to estimate
+    # (a strategy replaced, settings the model does not cover, or a load close to saturation)
+    if any(name in qm.Simulation.strategies for name in args):
+        return None
+
+    sections = {section: args[section] for section in ('Client', 'Server', 'Dependency')}
+    if not analytic.applies(**sections):
+        return None
+
+    s = analytic.estimate(ticks=ticks, **sections)
+    low, high = saturation_band
+    return None if low <= s['utilization'] <= high else s
+
+
+def sweep(points, warmup=500000, ticks=200000, seed=0, processes=None, start=None, precision=None,
+          totals=False, hybrid=False, common=False):
+    # Returns one row per point, in order: the point's settings followed by its stats(). Given start, a
+    # Simulation.snapshot() taken after warmup, every point carries on from that state instead of warming
+    # up from cold; points cannot then change the fixed_settings (ValueError). Given precision, each point
+    # warms up until steady and measures until its intervals are that tight (see
+    # Simulation.run_until_precise), with warmup and ticks as the limits. Given totals, each row also has the
+    # point's qm.Totals under 'totals'; these add up, histograms included, to merge runs (estimated rows have
+    # None). Given hybrid, points are estimated where they can be (see above). With Engine.export set, each
+    # point exports to a directory of its own within it, named by the point's position.
+    rng = random.Random(seed)
+    seeds = [seed if common else rng.getrandbits(64) for _ in points]
+    base = None if start is None else qm.Simulation.restore(start)
+    args = [simulation_args(point, base) for point in points]
+    for i, a in enumerate(args):
+        if a['Engine'].export:
+            a['Engine'].export = os.path.join(a['Engine'].export, str(i))
+    estimates = [estimate_point(a, ticks) if hybrid else None for a in args]
+    simulated = [i for i, e in enumerate(estimates) if e is None]
+    n = len(simulated)
+    runs = ([args[i] for i in simulated], [seeds[i] for i in simulated], [warmup] * n, [ticks] * n,
+            [start] * n, [precision] * n)
+
+    if processes == 1 or n <= 1:
+        results = list(map(run_point, *runs))
+    else:
+        with ProcessPoolExecutor(processes or os.cpu_count()) as pool:
+            results = list(pool.map(run_point, *runs))
+
+    for i, result in zip(simulated, results):
+        estimates[i] = result
+
+    rows = []
+    for point, result in zip(points, estimates):
+        row = {name: _label(value) for name, value in point.items()}
+        if isinstance(result, dict):
+            row.update(result)
+            t = None
+        else:
+            row.update(result[0])
+            t = result[1]
+        if hybrid:
+            row['estimated'] = t is None
+        if totals:
+            row['totals'] = t
+        rows.append(row)
+
+    return rows
+
+
+def _label(value):
+    # Strategies appear in the results by name
+    if isinstance(value, partial):
+        args = list(value.args) + list(value.keywords.values())
+        return "%s(%s)" % (value.func.__name__, ";".join(str(a) for a in args))
+    if callable(value):
+        return value.__name__
+    return value
+
+
+def print_table(rows):
+    if not rows:
+        return
+
+    # Rows need not all have the same stats (estimated ones have fewer), so columns are those of any row
+    columns = []
+    for row in rows:
+        columns += [c for c in row if c != 'totals' and c not in columns]
+
+    print(",".join(columns))
+    for row in rows:
+        values = (row.get(c, '') for c in columns)
+        print(",".join("%.2f" % v if isinstance(v, float) else str(v) for v in values))
+
+
+if __name__ == '__main__':
+    # The loadshedding.py exploration as a single parallel sweep
+
+    c_max = 4
+    qm.Server.q1_max = 1
+    qm.Server.q2_max = 1
+    qm.Server.ttl = 0
+
+    points = []
+    for c_1 in [4, 3, 2, 1, 0]:
+        c_2 = (c_max - c_1)*4
+        for rate in [50, 40, 30, 20, 10]:
+            points.append({'Server.p2_max': c_1, 'Server.p1_max': c_1 + c_2, 'Client.rate': rate})
+
+    print_table(sweep(points))
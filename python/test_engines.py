@@ -0,0 +1,45 @@
+import pytest
+
+import quartermaster as qm
+
+# The 'event' engine only skips ticks on which nothing can happen, so with the same seed it must respond to
+# the same requests in the same way as the 'tick' engine, whatever the arrivals, cache, admission policy
+# and queue disciplines. Run with `python -m pytest` from this directory.
+
+configurations = [
+    {},
+    {'Client.rate': 5, 'Server.tries': 2},
+    {'Client.rate': 3, 'Server.p1_max': 30, 'Server.p2_max': 4, 'Server.q1_max': 50, 'Server.q2_max': 40,
+     'Server.ttl': 2000, 'Server.tries': 3, 'Server.q2_discipline': 'lifo'},
+    {'Client.arrivals': 'poisson', 'Client.rate': 10, 'Server.cache_policy': 'lru', 'Server.cache_size': 500,
+     'Server.admission': 'aimd'},
+    {'Client.arrivals': 'burst', 'Server.ttl': 0, 'Server.tries': 2, 'Server.q2_discipline': 'priority'},
+    {'Client.arrivals': 'mmpp', 'Server.cache_policy': 'tinylfu', 'Server.cache_size': 200,
+     'Server.admission': 'two-threshold', 'Server.admission_normal': 12},
+    {'Client.arrivals': 'diurnal', 'Client.rate': 8, 'Client.diurnal_period': 20000, 'Server.ttl': 5000,
+     'Server.cache_policy': 'ttl', 'Server.admission': 'gradient', 'Server.q1_discipline': 'lifo'},
+]
+
+
+def run(settings, mode, ticks=60000):
+    sections = {'Client': {}, 'Server': {}, 'Engine': {'mode': mode}}
+    for name, value in settings.items():
+        section, _, setting = name.partition('.')
+        sections[section][setting] = value
+
+    sim = qm.Simulation(seed=1, **{section: qm.configuration(getattr(qm, section), **values)
+                                   for section, values in sections.items()})
+    sim.warmup(ticks // 3)
+    sim.main(sim.clock.ts + ticks)
+    responses = [(r.key, r.start_ts, r.end_ts, r.response_type, r.tries, r.q1_t, r.q2_t,
+                  round(r.dependency_t, 6)) for r in sim.completed]
+    return sim.stats(), responses
+
+
+@pytest.mark.parametrize('settings', configurations)
+def test_event_and_tick_agree(settings):
+    tick_stats, tick_responses = run(settings, 'tick')
+    event_stats, event_responses = run(settings, 'event')
+    assert tick_responses
+    assert event_responses == tick_responses
+    assert event_stats == tick_stats
@@ -0,0 +1,91 @@
+import random
+
+import pytest
+
+import quartermaster as qm
+
+# The queue disciplines against a plain list kept in the order each should serve, through a random mix of
+# enqueues, dequeues and removals from anywhere in the queue. Run with `python -m pytest` from this directory.
+
+
+def priority(r):
+    return r.key % 3
+
+
+def served_before(discipline, a, b):
+    # Whether request a is due out before b, both queued, with a queued first
+    if discipline == 'lifo':
+        return False
+    if discipline == 'priority':
+        return priority(a) >= priority(b)
+    return True
+
+
+def check(discipline, queue, model, limit):
+    assert len(queue) == len(model)
+    assert queue.empty() == (not model)
+    assert queue.items == model
+    assert [r.queue_p['q2'] for r in model] == list(range(len(model)))
+    assert queue.in_order(reversed(model)) == model
+
+    # Tombstones do not pile up: none are left at the head of a FIFO queue, and in the others they never
+    # outnumber the most requests the queue has held
+    if discipline == 'fifo':
+        assert not model or queue._entries[0][1] is model[0]
+    else:
+        assert len(queue._entries) <= 2 * limit + 1
+
+
+def insert(discipline, model, r):
+    i = len(model)
+    while i and not served_before(discipline, model[i - 1], r):
+        i -= 1
+    model.insert(i, r)
+
+
+@pytest.mark.parametrize('discipline', ['fifo', 'lifo', 'priority'])
+def test_order_and_positions(discipline):
+    sim = qm.Simulation(seed=0, priority=priority)
+    queue = qm.disciplines[discipline]('q2', sim)
+    rng = random.Random(1)
+    model = []
+    limit = 50
+    for key in range(20000):
+        op = rng.random()
+        if op < 0.45 and len(model) < limit:
+            r = qm.Request(key, sim.clock.ts)
+            queue.enqueue(r)
+            insert(discipline, model, r)
+
+        elif op < 0.8 and model:
+            r = model.pop(rng.randrange(len(model)))
+            queue.remove(r)
+            assert r.queue is None and r.queue_p['q2'] == -1
+
+        elif model:
+            assert queue.dequeue() is model.pop(0)
+
+        check(discipline, queue, model, limit)
+
+    while model:
+        assert queue.dequeue() is model.pop(0)
+    check(discipline, queue, model, limit)
+
+
+@pytest.mark.parametrize('discipline', ['fifo', 'lifo', 'priority'])
+def test_removed_under_the_head(discipline):
+    # An overloaded queue that only ever loses requests away from its head, as q2 does to abandon() when the
+    # oldest requests are at the bottom of a stack
+    sim = qm.Simulation(seed=0, priority=priority)
+    queue = qm.disciplines[discipline]('q2', sim)
+    model = []
+    limit = 10
+    for key in range(10000):
+        r = qm.Request(key, sim.clock.ts)
+        queue.enqueue(r)
+        insert(discipline, model, r)
+        if len(model) > limit:
+            r = model.pop(len(model) - 1 if discipline == 'fifo' else 1)
+            queue.remove(r)
+
+        check(discipline, queue, model, limit)
@@ -20,7 +20,7 @@ std = 25
 def dependency():
     normal_case_probability = 0.75
 
-    if qm.coin_toss(normal_case_probability):  # case 1
+    if qm.coin_toss(normal_case_probability, qm.random_latency):  # case 1
         mean = normal_mean
         availability = 0.98
 
@@ -28,11 +28,14 @@ def dependency():
         mean = slow_mean
         availability = 0
 
-    t = qm.normal(mean, std)
+    # Drawn from the simulation's own streams, the coin included whether or not the call times out, so that
+    # the two timeouts compared below see the same calls (see SIMULATIONS RUN)
+    t = qm.normal(mean, std, qm.random_latency)
+    available = qm.coin_toss(availability, qm.random_availability)
     if t > timeout:
         return timeout, 'timeout'
 
-    return t, 'success' if (qm.coin_toss(availability)) else 'failure'
+    return t, 'success' if available else 'failure'
 
 
 qm.dependency = dependency  # override the normal dependency function
@@ -56,7 +59,10 @@ qm.Client.decay_max = 500
 
 # The first exploration we ran uses a large timeout, while simulating situation (2). The idea here is that the server will wait for the response from the dependency even if we happen to hit the slow case.
 
+# Both timeouts are run with the same seed, so that they see the same arrivals and the same dependency calls (common random numbers), and the difference in QoS between them is measured batch by batch with a confidence interval (qm.paired_difference). Most of the noise cancels out of the difference, so it is settled in far fewer ticks than comparing two independent runs would take.
+
 stat_rows = []
+differences = []
 
 
 def _add(stats):
@@ -80,21 +86,25 @@ for slow_mean in [150, 200, 250, 300, 350, 400, 450, 500]:
         # For each decay, mean and tries triple, we will try a large timeout--set to decay_max; there is no reason to wait longer because the request QoS will be 0 at that point.
 
         timeout = qm.Client.decay_max
-        qm.setup()
-        qm.run_experiment(200000)
+        qm.setup(seed=slow_mean)
+        batches_1 = qm.run_batches(200000)
+        qm.report()
         _add(qm.stats())
 
         timeout = normal_mean + 2*std
-        qm.setup()
-        qm.run_experiment(200000)
+        qm.setup(seed=slow_mean)
+        batches_2 = qm.run_batches(200000)
+        qm.report()
         _add(qm.stats())
 
-print("decay_max, mean_delta, max_tries, timeout_1, qos_1, latency_1, timeout_2, qos_2, latency_2")
-for i, j in zip(stat_rows[::2], stat_rows[1::2]):
-    print("%d,%d,%d,%d,%.2f,%.2f,%d,%.2f,%.2f" %
+        differences.append(qm.paired_difference(batches_1, batches_2)['qos'])
+
+print("decay_max, mean_delta, max_tries, timeout_1, qos_1, latency_1, timeout_2, qos_2, latency_2, qos_delta, ci")
+for i, j, (delta, h, n) in zip(stat_rows[::2], stat_rows[1::2], differences):
+    print("%d,%d,%d,%d,%.2f,%.2f,%d,%.2f,%.2f,%.3f,%.3f" %
           (i['decay_max'], i['slow_mean']-normal_mean, i['max_tries'],
            i['timeout'], i['qos'], i['latency'],
-              j['timeout'], j['qos'], j['latency']))
+              j['timeout'], j['qos'], j['latency'], delta, h))
 
 # INSIGHTS
 